@@ -1,12 +1,12 @@
 from bitcoinutils import setup
 from bitcoinutils.constants import TYPE_RELATIVE_TIMELOCK
 from bitcoinutils.keys import P2pkhAddress, PublicKey
-from bitcoinutils.transactions import Transaction, TxInput, TxOutput, Sequence
+from bitcoinutils.transactions import Transaction, TxInput, TxOutput, Sequence, Locktime
 from bitcoinutils.script import Script
 from bitcoinutils.utils import to_satoshis
 
 from channel import createOpenChannelTx, signOpenChannelTxLeft, signOpenChannelTxRight, getChannelStateScriptSigLeft, getChannelStateScriptSigRight, signChannelStateTx
-from helper import Id, print_tx
+from helper import Id, copy_tx_input, print_tx
 from typing import List
 
 
@@ -68,7 +68,7 @@ def createTxState(tx_in: TxInput, pubkey_left: PublicKey, pubkey_right: PublicKe
     tx_out_left = TxOutput(left_val, P2pkhAddress(pubkey_left.get_address().to_string()).to_script_pub_key())
     tx_out_right = TxOutput(right_val, P2pkhAddress(pubkey_right.get_address().to_string()).to_script_pub_key())
 
-    tx = Transaction([tx_in], [tx_out_lock, tx_out_left, tx_out_right])
+    tx = Transaction([copy_tx_input(tx_in)], [tx_out_lock, tx_out_left, tx_out_right])
 
     return tx
 
@@ -101,7 +101,7 @@ def createTxER(tx_in: TxInput, public_keys: List[PublicKey], rel_timelock, eps:
     for pubkey in public_keys:
         out_list.append(TxOutput(eps, getTxEROutputLockScript(pubkey, rel_timelock)))
 
-    tx_er = Transaction([tx_in], out_list)
+    tx_er = Transaction([copy_tx_input(tx_in)], out_list)
     return tx_er
 
 
@@ -140,11 +140,11 @@ def createTxRefund(tx_er_input: TxInput, tx_state_input: TxInput, id_er: Id, id_
 
     out_refund = TxOutput(lock_coins + eps - fee, id_refund.p2pkh)
 
-    tx_refund = Transaction([tx_er_input, tx_state_input], [out_refund])
+    tx_refund = Transaction([copy_tx_input(tx_er_input), copy_tx_input(tx_state_input)], [out_refund])
 
     er_in_lock_script = getTxEROutputLockScript(id_er.public_key, rel_lock)
     sig_er_in = id_er.private_key.sign_input(tx_refund, 0, er_in_lock_script)
-    tx_er_input.script_sig = Script([sig_er_in, id_er.public_key.to_hex()])
+    tx_refund.inputs[0].script_sig = Script([sig_er_in, id_er.public_key.to_hex()])
 
     # should be also signed by right for 2/2 multisig
     sig_state_left = id_state_ref_left.private_key.sign_input(tx_refund, 1, tx_state_lock_script)
@@ -180,7 +180,7 @@ def signTxRefundStateInput(tx_refund: Transaction, sig_left: str, sig_right: str
 
 
 def createTxPayAndSign(tx_state_input: TxInput, id_state_pay_right: Id, tx_state_lock_script: Script,
-                    id_pay_receiver: Id, lock_coins: float, fee: float) -> Transaction:
+                    id_pay_receiver: Id, lock_coins: float, fee: float, T: int) -> Transaction:
     """
     Right can spend locked coins after time T wherever he wants
 
@@ -190,14 +190,15 @@ def createTxPayAndSign(tx_state_input: TxInput, id_state_pay_right: Id, tx_state
     :param id_pay_receiver: id that will own coins if transaction will be published
     :param lock_coins: coins locked in tx_state
     :param fee: coins paid to miners
+    :param T: locktime of tx_pay, same T as in tx_state lock script. Smaller value fails OP_CHECKLOCKTIMEVERIFY
     :return: transaction for pay to right user, valid after time T
     """
 
     out_pay = TxOutput(lock_coins - fee, id_pay_receiver.p2pkh)
-    tx_pay = Transaction([tx_state_input], [out_pay])
+    tx_pay = Transaction([copy_tx_input(tx_state_input)], [out_pay], locktime=Locktime(T).for_transaction())
 
     signature = id_state_pay_right.private_key.sign_input(tx_pay, 0, tx_state_lock_script)
-    tx_state_input.script_sig = Script([signature, id_state_pay_right.public_key.to_hex(), 'OP_0', 'OP_0', 'OP_0', 'OP_0', 'OP_0', 'OP_0'])
+    tx_pay.inputs[0].script_sig = Script([signature, id_state_pay_right.public_key.to_hex(), 'OP_0', 'OP_0', 'OP_0', 'OP_0', 'OP_0', 'OP_0'])
 
     return tx_pay
 
@@ -275,7 +276,7 @@ def main():
     print_tx(tx_refund, 'tx refund')
 
     tx_pay = createTxPayAndSign(tx_state_lock_input, id_pay_right, state_lock_script, id_pay_receiver,
-                                lock_amount, to_satoshis(0.00000600))
+                                lock_amount, to_satoshis(0.00000600), T)
     print_tx(tx_pay, 'tx pay')
 
 
@@ -3,7 +3,7 @@ from bitcoinutils.keys import PublicKey
 from bitcoinutils.script import Script
 from bitcoinutils.transactions import Transaction, TxInput, TxOutput
 
-from helper import print_tx, Id
+from helper import copy_tx_input, print_tx, Id
 
 
 def getChannelLockScript(pubkey_left: PublicKey, pubkey_right: PublicKey) -> Script:
@@ -16,7 +16,7 @@ def createOpenChannelTx(tx_in_left: TxInput, tx_in_right: TxInput, amount_left:
     script_pubkey = getChannelLockScript(pubkey_left, pubkey_right)
     tx_out = TxOutput(amount_left + amount_right, script_pubkey)
 
-    tx = Transaction([tx_in_left, tx_in_right], [tx_out])
+    tx = Transaction([copy_tx_input(tx_in_left), copy_tx_input(tx_in_right)], [tx_out])
     return tx
 
 
@@ -0,0 +1,220 @@
+import heapq
+import itertools
+from typing import Callable, Dict, List, Optional
+
+from bitcoinutils.transactions import Transaction
+
+from helper import LOCKTIME_THRESHOLD
+
+BLOCK_INTERVAL = 600  # expected seconds between blocks, to compare time and height deadlines
+
+
+class Claim:
+    """
+    Transaction that spends an output of a pending payment. Valid from tip <earliest> and safe to publish
+    until tip <latest> (None if there is no deadline). Both are block heights, or unix times if they are
+    at least LOCKTIME_THRESHOLD, same as locktime. A claim with time bounds can also have relative locks
+    or deadlines counted in blocks: then it is valid only from tip height <min_height> and safe only until
+    tip height <max_height>
+    """
+
+    __slots__ = ('payment', 'kind', 'tx', 'earliest', 'latest', 'min_height', 'max_height', 'cancelled')
+
+    def __init__(self, payment: str, kind: str, tx: Transaction, earliest: int, latest: Optional[int] = None,
+                 min_height: int = 0, max_height: Optional[int] = None):
+        self.payment = payment
+        self.kind = kind
+        self.tx = tx
+        self.earliest = earliest
+        self.latest = latest
+        self.min_height = min_height
+        self.max_height = max_height
+        self.cancelled = False
+
+
+def _isHeight(locktime: int) -> bool:
+    return locktime < LOCKTIME_THRESHOLD
+
+
+def refundClaim(payment: str, tx_refund: Transaction, er_height: int, state_height: int,
+                tx_er_rel_timelock: int, delta: int, T: int) -> Claim:
+    """
+    :param er_height: height of block with enable-refund transaction
+    :param state_height: height of block with tx_state
+    :param tx_er_rel_timelock: relative lock on tx_er outputs
+    :param delta: relative lock on tx_state lock output
+    :param T: after this height or time right user can take locked coins with tx_pay, so refund should land before
+    :return: claim for tx_refund
+    """
+
+    earliest = max(er_height + tx_er_rel_timelock, state_height + delta) - 1
+    return Claim(payment, 'refund', tx_refund, earliest, T - 1)
+
+
+def instPayClaim(payment: str, tx_inst_pay: Transaction, ep_height: int, state_height: int,
+                 tx_ep_rel_timelock: int, delta: int, T: int, refund_earliest: Optional[int] = None) -> Claim:
+    """
+    :param ep_height: height of block with enable-payment transaction
+    :param state_height: height of block with tx_state
+    :param tx_ep_rel_timelock: relative lock on tx_ep outputs
+    :param delta: relative lock on tx_state lock output
+    :param T: locktime of tx_pay, inst-pay must land before
+    :param refund_earliest: earliest of refund claim if enable-refund transaction is published, inst-pay must land before
+    :return: claim for tx_inst_pay
+    """
+
+    earliest = max(ep_height + tx_ep_rel_timelock, state_height + delta) - 1
+    if not _isHeight(T):
+        max_height = refund_earliest - 1 if refund_earliest is not None else None
+        return Claim(payment, 'inst_pay', tx_inst_pay, earliest, T - 1, max_height=max_height)
+    latest = T - 1 if refund_earliest is None else min(T, refund_earliest) - 1
+    return Claim(payment, 'inst_pay', tx_inst_pay, earliest, latest)
+
+
+def payClaim(payment: str, tx_pay: Transaction, state_height: int, delta: int, T: int) -> Claim:
+    """
+    :param state_height: height of block with tx_state
+    :param delta: relative lock on tx_state lock output
+    :param T: locktime of tx_pay
+    :return: claim for tx_pay
+    """
+
+    if _isHeight(T):
+        return Claim(payment, 'pay', tx_pay, max(T, state_height + delta - 1))
+    # median time past of tip must be above T, and relative lock on tx_state output counts blocks anyway
+    return Claim(payment, 'pay', tx_pay, T + 1, min_height=state_height + delta - 1)
+
+
+class ClaimScheduler:
+    """
+    Pending claims in priority queues by earliest valid height and time. On every block only due claims
+    are popped and handed to broadcast in batches, most urgent (closest latest) first, so cost of a block
+    depends on number of due claims, not on number of open payments
+    """
+
+    def __init__(self, broadcast: Callable[[List[Claim]], None], batch_size: int = 100,
+                 height: int = 0, time: int = 0, block_interval: int = BLOCK_INTERVAL):
+        """
+        :param broadcast: publishes a batch of claims
+        :param batch_size: maximal number of claims in a batch
+        :param height: current tip height
+        :param time: current median time past
+        :param block_interval: expected seconds between blocks
+        """
+
+        self.broadcast = broadcast
+        self.batch_size = batch_size
+        self.height = height
+        self.time = time
+        self.block_interval = block_interval
+        self.by_height = []  # heap of (earliest, n, claim)
+        self.by_time = []
+        self.counter = itertools.count()
+        self.payments: Dict[str, List[Claim]] = {}
+
+    def __len__(self) -> int:
+        return len(self.by_height) + len(self.by_time)
+
+    def add(self, claim: Claim) -> None:
+        heap = self.by_height if _isHeight(claim.earliest) else self.by_time
+        heapq.heappush(heap, (claim.earliest, next(self.counter), claim))
+        self.payments.setdefault(claim.payment, []).append(claim)
+
+    def cancel(self, payment: str) -> None:
+        """
+        Drop all claims of payment, for example when one of them is confirmed. Claims stay in queues
+        and are skipped when popped
+
+        :param payment: payment id
+        """
+
+        for claim in self.payments.pop(payment, []):
+            claim.cancelled = True
+
+    def _remove(self, claim: Claim) -> None:
+        claims = self.payments.get(claim.payment)
+        if claims is not None:
+            claims.remove(claim)
+            if not claims:
+                del self.payments[claim.payment]
+
+    def _deadline(self, claim: Claim) -> float:
+        # latest as estimated height, to order height and time deadlines together
+        deadline = float('inf') if claim.max_height is None else claim.max_height
+        if claim.latest is None:
+            return deadline
+        if _isHeight(claim.latest):
+            return min(deadline, claim.latest)
+        return min(deadline, self.height + (claim.latest - self.time) / self.block_interval)
+
+    def _expired(self, claim: Claim) -> bool:
+        if claim.max_height is not None and claim.max_height < self.height:
+            return True
+        if claim.latest is None:
+            return False
+        if _isHeight(claim.latest):
+            return claim.latest < self.height
+        return claim.latest < self.time
+
+    def on_block(self, height: int, time: int) -> List[Claim]:
+        """
+        Broadcast claims that became valid at new tip
+
+        :param height: new tip height
+        :param time: median time past of new tip
+        :return: claims whose latest passed before they became valid
+        """
+
+        self.height = height
+        self.time = time
+
+        due = []
+        for heap, now in ((self.by_height, height), (self.by_time, time)):
+            while heap and heap[0][0] <= now:
+                claim = heapq.heappop(heap)[2]
+                if claim.cancelled:
+                    continue
+                if claim.min_height > height:
+                    # median time past never decreases, so only the height is left to wait for
+                    heapq.heappush(self.by_height, (claim.min_height, next(self.counter), claim))
+                    continue
+                self._remove(claim)
+                due.append(claim)
+
+        expired = [claim for claim in due if self._expired(claim)]
+        due = [claim for claim in due if not self._expired(claim)]
+        due.sort(key=self._deadline)
+        for i in range(0, len(due), self.batch_size):
+            self.broadcast(due[i:i + self.batch_size])
+        return expired
+
+
+def test_claim_scheduler():
+    batches = []
+    now = 1600000000  # median time past of tip at height 100
+    scheduler = ClaimScheduler(lambda batch: batches.append([claim.payment for claim in batch]), batch_size=2, height=100, time=now)
+    tx = Transaction([], [])
+
+    scheduler.add(refundClaim('a', tx, 100, 100, 20, 5, 130))  # valid from 119 until 129
+    scheduler.add(payClaim('b', tx, 100, 5, 110))  # valid from 110
+    scheduler.add(instPayClaim('c', tx, 100, 100, 3, 5, 115))  # valid from 104 until 114
+    scheduler.add(payClaim('d', tx, 100, 50, now + 600))  # valid after T, but not before height 149
+    scheduler.add(refundClaim('e', tx, 100, 100, 2, 2, now + 1200))  # valid from 101 until time T - 1
+    scheduler.add(instPayClaim('f', tx, 100, 100, 3, 5, now + 900, refund_earliest=119))  # deadlines T - 1 and 118
+    scheduler.add(refundClaim('g', tx, 100, 100, 60, 2, now + 1500))  # valid from 159, after its time deadline
+    scheduler.add(payClaim('h', tx, 100, 5, 105))
+    scheduler.cancel('h')
+
+    assert scheduler.on_block(101, now + 60) == [] and batches == [['e']]
+    # most urgent first: 'f' must land by time now + 899, 'c' by height 114, 'b' has no deadline
+    assert scheduler.on_block(110, now + 700) == [] and batches[1:] == [['f', 'c'], ['b']]
+    expired = scheduler.on_block(140, now + 2000)
+    assert [claim.payment for claim in expired] == ['a'] and len(batches) == 3
+    assert scheduler.on_block(149, now + 2600) == [] and batches[3:] == [['d']]
+    expired = scheduler.on_block(159, now + 3000)
+    assert [claim.payment for claim in expired] == ['g'] and len(batches) == 4
+    assert len(scheduler) == 0 and not scheduler.payments
+
+    # inst-pay with time T expires by the height deadline of refund
+    scheduler.add(instPayClaim('i', tx, 159, 159, 3, 5, now + 9000, refund_earliest=165))
+    assert [claim.payment for claim in scheduler.on_block(170, now + 4000)] == ['i']
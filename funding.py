@@ -0,0 +1,226 @@
+import itertools
+import os
+import threading
+from bisect import bisect_left, insort
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from bitcoinutils import setup
+from bitcoinutils.script import Script
+from bitcoinutils.transactions import Transaction, TxInput, TxOutput
+from bitcoinutils.utils import to_satoshis
+
+from helper import Id, copy_tx_input
+
+# sizes of legacy p2pkh transaction parts in bytes
+TX_OVERHEAD_SIZE = 10
+P2PKH_INPUT_SIZE = 148
+P2PKH_OUTPUT_SIZE = 34
+MAX_SPLIT_OUTPUTS = 2000
+MAX_TX_SIZE = 100000  # standardness limit, inputs and outputs of split tx together stay below it
+DUST_LIMIT = 546
+
+
+class FundingUtxo(NamedTuple):
+    tx_in: TxInput
+    amount: int
+    owner: Id  # id that can sign spending of this output (p2pkh)
+
+
+def getSplitTxSize(inputs_number: int, outputs_number: int) -> int:
+    return TX_OVERHEAD_SIZE + P2PKH_INPUT_SIZE * inputs_number + P2PKH_OUTPUT_SIZE * outputs_number
+
+
+def createSplitTx(sources: List[FundingUtxo], owners: List[Id], value: int,
+                  change_owner: Optional[Id] = None, change_value: int = 0) -> Transaction:
+    """
+    Split funding outputs into outputs of equal value, for example into funding of channels and enable transactions
+
+    :param sources: outputs to spend
+    :param owners: ids that will own new outputs, one output per id
+    :param value: value of each new output
+    :param change_owner: id that will own the rest of coins
+    :param change_value: value of change output, not created if 0
+    :return: unsigned split transaction
+    """
+
+    outputs = [TxOutput(value, owner.p2pkh) for owner in owners]
+    if change_value:
+        outputs.append(TxOutput(change_value, change_owner.p2pkh))
+    return Transaction([copy_tx_input(source.tx_in) for source in sources], outputs)
+
+
+def signSplitTx(tx: Transaction, sources: List[FundingUtxo]) -> Transaction:
+    """
+    :param tx: split transaction
+    :param sources: outputs spent by split transaction, in the same order as its inputs
+    :return: signed split transaction
+    """
+
+    for index, source in enumerate(sources):
+        signature = source.owner.private_key.sign_input(tx, index, source.owner.p2pkh)
+        tx.inputs[index].script_sig = Script([signature, source.owner.public_key.to_hex()])
+    return tx
+
+
+def planSplitTxs(sources: List[FundingUtxo], value: int, count: int, new_owner: Callable[[], Id],
+                 change_owner: Id, fee_per_byte: int = 1,
+                 max_outputs: int = MAX_SPLIT_OUTPUTS) -> List[Tuple[Transaction, List[Id]]]:
+    """
+    Build as few split transactions as possible that create <count> outputs of <value> each.
+    Largest sources are spent first. Change of every transaction is spent by the next one, small sources
+    are merged into a transaction until it can fill <max_outputs> outputs or reaches MAX_TX_SIZE
+
+    :param sources: outputs to spend
+    :param value: value of each new output
+    :param count: number of outputs to create
+    :param new_owner: returns id for the next new output
+    :param change_owner: id that will own change outputs
+    :param fee_per_byte: fee rate in satoshis per byte
+    :param max_outputs: maximal number of new outputs in one transaction
+    :return: signed split transactions along with owners of their outputs (change excluded).
+    Raises ValueError if sources are not enough for <count> outputs
+    """
+
+    sources = sorted(sources, key=lambda source: source.amount, reverse=True)
+    position = 0
+    change_utxo = None
+    requested = count
+    txs = []
+    while count > 0:
+        target = min(count, max_outputs)
+        spent = [change_utxo] if change_utxo is not None else []
+        total = change_utxo.amount if change_utxo is not None else 0
+        while position < len(sources) and getSplitTxSize(len(spent) + 1, 2) <= MAX_TX_SIZE and \
+                total < target * value + getSplitTxSize(len(spent) + 1, target + 1) * fee_per_byte:
+            spent.append(sources[position])
+            total += sources[position].amount
+            position += 1
+
+        outputs_number = min(target,
+                             (total - getSplitTxSize(len(spent), 1) * fee_per_byte) // (value + P2PKH_OUTPUT_SIZE * fee_per_byte),
+                             (MAX_TX_SIZE - getSplitTxSize(len(spent), 1)) // P2PKH_OUTPUT_SIZE)
+        if outputs_number <= 0:
+            break
+
+        change = total - outputs_number * value - getSplitTxSize(len(spent), outputs_number + 1) * fee_per_byte
+        if change < DUST_LIMIT:
+            change = 0
+
+        owners = [new_owner() for _ in range(outputs_number)]
+        tx = signSplitTx(createSplitTx(spent, owners, value, change_owner, change), spent)
+        txs.append((tx, owners))
+        count -= outputs_number
+        change_utxo = FundingUtxo(TxInput(tx.get_txid(), outputs_number), change, change_owner) if change else None
+
+    if count > 0:
+        raise ValueError(f'sources are enough for {requested - count} of {requested} outputs of value {value}')
+    return txs
+
+
+class UtxoPool:
+    """
+    Pool of pre-funded p2pkh outputs indexed by value, to hand them out to payment setup without on-chain steps.
+    Safe to use from several threads, for example by ladder.StateLadder filler and by online payments
+    """
+
+    def __init__(self):
+        self.by_value: Dict[int, List[FundingUtxo]] = {}
+        self.values: List[int] = []  # sorted values that have at least one output
+        self.size = 0
+        self.lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return self.size
+
+    def count(self, value: int) -> int:
+        with self.lock:
+            return len(self.by_value.get(value, []))
+
+    def count_at_least(self, value: int) -> int:
+        with self.lock:
+            return sum(len(self.by_value[v]) for v in self.values[bisect_left(self.values, value):])
+
+    def add(self, utxo: FundingUtxo) -> None:
+        with self.lock:
+            bucket = self.by_value.get(utxo.amount)
+            if not bucket:
+                bucket = self.by_value[utxo.amount] = []
+                insort(self.values, utxo.amount)
+            bucket.append(utxo)
+            self.size += 1
+
+    def add_split_tx(self, tx: Transaction, owners: List[Id]) -> None:
+        """
+        Add outputs of split transaction to the pool
+
+        :param tx: split transaction
+        :param owners: id for each output, in order. Outputs after the last owner (change) are skipped
+        """
+
+        txid = tx.get_txid()
+        with self.lock:
+            for index, owner in enumerate(owners):
+                self.add(FundingUtxo(TxInput(txid, index), tx.outputs[index].amount, owner))
+
+    def take(self, value: int) -> FundingUtxo:
+        """
+        :param value: exact value of output
+        :return: output of given value, removed from the pool. Raises KeyError if there is none
+        """
+
+        with self.lock:
+            bucket = self.by_value.get(value)
+            if not bucket:
+                raise KeyError(f'no funding output of value {value}')
+            utxo = bucket.pop()
+            self.size -= 1
+            if not bucket:
+                self.values.pop(bisect_left(self.values, value))
+            return utxo
+
+    def take_at_least(self, value: int) -> FundingUtxo:
+        """
+        :param value: minimal value of output
+        :return: smallest output with value at least <value>, removed from the pool. Raises KeyError if there is none
+        """
+
+        with self.lock:
+            position = bisect_left(self.values, value)
+            if position == len(self.values):
+                raise KeyError(f'no funding output of value at least {value}')
+            return self.take(self.values[position])
+
+
+def test_plan_split_txs():
+    setup.setup('testnet')
+    keys = (Id(os.urandom(32).hex()) for _ in itertools.count())
+    change_owner = next(keys)
+
+    def newSource(amount: int) -> FundingUtxo:
+        owner = next(keys)
+        return FundingUtxo(TxInput(os.urandom(32).hex(), 0), amount, owner)
+
+    # one large source: change of every split tx funds the next one
+    txs = planSplitTxs([newSource(to_satoshis(10))], 10000, 50, lambda: next(keys), change_owner, max_outputs=20)
+    assert [len(owners) for _, owners in txs] == [20, 20, 10]
+    for (previous, owners), (tx, _) in zip(txs, txs[1:]):
+        assert len(tx.inputs) == 1
+        assert (tx.inputs[0].txid, tx.inputs[0].txout_index) == (previous.get_txid(), len(owners))
+
+    pool = UtxoPool()
+    for tx, owners in txs:
+        pool.add_split_tx(tx, owners)
+    assert len(pool) == pool.count(10000) == 50
+    assert pool.take_at_least(5000).amount == 10000 and len(pool) == 49
+
+    # many small sources: inputs count toward the size limit
+    txs = planSplitTxs([newSource(1500) for _ in range(1000)], 1000, 700, lambda: next(keys), change_owner)
+    assert sum(len(owners) for _, owners in txs) == 700
+    assert len(txs) > 1 and all(len(tx.serialize()) // 2 <= MAX_TX_SIZE for tx, _ in txs)
+
+    try:
+        planSplitTxs([newSource(100000)], 10000, 20, lambda: next(keys), change_owner)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('expected ValueError for not enough funds')
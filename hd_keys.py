@@ -0,0 +1,271 @@
+import hashlib
+import hmac
+import struct
+from collections import OrderedDict
+from typing import Dict, List, Optional, Union
+
+import base58
+from ecdsa import SECP256k1, VerifyingKey
+
+from bitcoinutils.keys import PublicKey
+from bitcoinutils.setup import get_network
+
+from helper import Id, hash160
+
+HARDENED = 1 << 31
+PURPOSE = 1017  # first level of node key paths: m / PURPOSE' / channel' / payment / role
+PAYMENT_NODES_CACHE_SIZE = 1024
+
+# roles of per-payment identities, index in ROLES is the last level of derivation path
+ROLES = ['er_owner', 'ep_owner', 'state_left', 'state_right', 'refund_mulsig_left', 'refund_mulsig_right',
+         'pay_mulsig_left', 'pay_mulsig_right', 'pay_right', 'refund_receiver', 'pay_receiver', 'inst_pay_receiver']
+# roles whose private keys are held by left (paying) and right (receiving) user
+LEFT_ROLES = ['er_owner', 'state_left', 'refund_mulsig_left', 'pay_mulsig_left', 'refund_receiver']
+RIGHT_ROLES = ['ep_owner', 'state_right', 'refund_mulsig_right', 'pay_mulsig_right', 'pay_right', 'pay_receiver',
+               'inst_pay_receiver']
+
+_VERSIONS = {  # (private, public)
+    'mainnet': (0x0488ADE4, 0x0488B21E),
+    'testnet': (0x04358394, 0x043587CF),
+}
+_ORDER = SECP256k1.order
+
+
+def _point_to_bytes(point) -> bytes:
+    return VerifyingKey.from_public_point(point, curve=SECP256k1).to_string('compressed')
+
+
+def _bytes_to_point(data: bytes):
+    return VerifyingKey.from_string(data, curve=SECP256k1).pubkey.point
+
+
+class HdNode:
+    """
+    BIP32 extended key. Private nodes derive hardened and normal children, public nodes (neuter())
+    derive only normal children, which have the same public keys as normal children of the private node
+    """
+
+    def __init__(self, chain_code: bytes, secret: Optional[int] = None, public_key: Optional[bytes] = None,
+                 depth: int = 0, parent_fingerprint: bytes = b'\0\0\0\0', index: int = 0):
+        self.chain_code = chain_code
+        self.secret = secret
+        self.public_key = public_key if public_key is not None else _point_to_bytes(SECP256k1.generator * secret)
+        self.depth = depth
+        self.parent_fingerprint = parent_fingerprint
+        self.index = index
+        self.children: Dict[int, 'HdNode'] = {}
+
+    @classmethod
+    def from_seed(cls, seed: bytes) -> 'HdNode':
+        digest = hmac.new(b'Bitcoin seed', seed, hashlib.sha512).digest()
+        secret = int.from_bytes(digest[:32], 'big')
+        if secret == 0 or secret >= _ORDER:
+            raise ValueError('invalid seed')
+        return cls(digest[32:], secret)
+
+    @property
+    def is_private(self) -> bool:
+        return self.secret is not None
+
+    def fingerprint(self) -> bytes:
+        return hash160(self.public_key)[:4]
+
+    def child(self, index: int, cache: bool = False) -> 'HdNode':
+        """
+        :param index: child index, hardened if at least HARDENED
+        :param cache: keep derived child in this node to not derive it again
+        :return: child node, private if this node is private
+        """
+
+        node = self.children.get(index)
+        if node is not None:
+            return node
+
+        if index >= HARDENED:
+            if not self.is_private:
+                raise ValueError('hardened child of public node')
+            data = b'\0' + self.secret.to_bytes(32, 'big') + struct.pack('>I', index)
+        else:
+            data = self.public_key + struct.pack('>I', index)
+        digest = hmac.new(self.chain_code, data, hashlib.sha512).digest()
+        tweak = int.from_bytes(digest[:32], 'big')
+        if tweak >= _ORDER:
+            raise ValueError('invalid child, use next index')
+
+        if self.is_private:
+            secret = (self.secret + tweak) % _ORDER
+            if secret == 0:
+                raise ValueError('invalid child, use next index')
+            node = HdNode(digest[32:], secret, None, self.depth + 1, self.fingerprint(), index)
+        else:
+            point = SECP256k1.generator * tweak + _bytes_to_point(self.public_key)
+            node = HdNode(digest[32:], None, _point_to_bytes(point), self.depth + 1, self.fingerprint(), index)
+
+        if cache:
+            self.children[index] = node
+        return node
+
+    def derive(self, path: Union[str, List[int]]) -> 'HdNode':
+        """
+        :param path: list of indexes or string like "m/1017'/0'/5/2" (relative to this node)
+        :return: descendant node, intermediate nodes are cached
+        """
+
+        if isinstance(path, str):
+            path = parsePath(path)
+        node = self
+        for i, index in enumerate(path):
+            node = node.child(index, cache=i < len(path) - 1)
+        return node
+
+    def neuter(self) -> 'HdNode':
+        return HdNode(self.chain_code, None, self.public_key, self.depth, self.parent_fingerprint, self.index)
+
+    def to_id(self) -> Id:
+        if not self.is_private:
+            raise ValueError('public node has no private key')
+        return Id(self.secret.to_bytes(32, 'big').hex())
+
+    def get_public_key(self) -> PublicKey:
+        return PublicKey(self.public_key.hex())
+
+    def serialize(self) -> str:
+        """
+        :return: xprv / xpub (tprv / tpub on testnet) string
+        """
+
+        versions = _VERSIONS['mainnet' if get_network() == 'mainnet' else 'testnet']
+        if self.is_private:
+            version, key = versions[0], b'\0' + self.secret.to_bytes(32, 'big')
+        else:
+            version, key = versions[1], self.public_key
+        data = struct.pack('>IB', version, self.depth) + self.parent_fingerprint + struct.pack('>I', self.index) + self.chain_code + key
+        return base58.b58encode_check(data).decode()
+
+    @classmethod
+    def deserialize(cls, extended_key: str) -> 'HdNode':
+        data = base58.b58decode_check(extended_key)
+        if len(data) != 78:
+            raise ValueError('invalid extended key')
+        version, depth = struct.unpack('>IB', data[:5])
+        index = struct.unpack('>I', data[9:13])[0]
+        key = data[45:]
+        if any(version == versions[0] for versions in _VERSIONS.values()):
+            return cls(data[13:45], int.from_bytes(key[1:], 'big'), None, depth, data[5:9], index)
+        if any(version == versions[1] for versions in _VERSIONS.values()):
+            return cls(data[13:45], None, key, depth, data[5:9], index)
+        raise ValueError('unknown extended key version')
+
+
+def parsePath(path: str) -> List[int]:
+    indexes = []
+    for part in path.split('/'):
+        if part in ('m', 'M', ''):
+            continue
+        if part[-1] in "'hH":
+            indexes.append(int(part[:-1]) + HARDENED)
+        else:
+            indexes.append(int(part))
+    return indexes
+
+
+class NodeKeys:
+    """
+    All identities of a node derived from one seed: m / PURPOSE' / channel' / payment / role.
+    Channel node is hardened, so its xpub can be given to the counterparty, who then derives
+    per-payment public keys locally, without key exchange for every payment
+    """
+
+    def __init__(self, seed: bytes):
+        self.root = HdNode.from_seed(seed).child(PURPOSE + HARDENED)
+        self.channel_nodes: Dict[int, HdNode] = {}
+        self.payment_nodes: Dict[tuple, HdNode] = OrderedDict()
+
+    def channel_node(self, channel: int) -> HdNode:
+        node = self.channel_nodes.get(channel)
+        if node is None:
+            node = self.channel_nodes[channel] = self.root.child(channel + HARDENED)
+        return node
+
+    def channel_xpub(self, channel: int) -> str:
+        """
+        :return: extended public key to share with counterparty when channel is opened
+        """
+
+        return self.channel_node(channel).neuter().serialize()
+
+    def payment_node(self, channel: int, payment: int) -> HdNode:
+        key = (channel, payment)
+        node = self.payment_nodes.get(key)
+        if node is None:
+            node = self.payment_nodes[key] = self.channel_node(channel).child(payment)
+            if len(self.payment_nodes) > PAYMENT_NODES_CACHE_SIZE:
+                self.payment_nodes.popitem(last=False)
+        else:
+            self.payment_nodes.move_to_end(key)
+        return node
+
+    def get_id(self, channel: int, payment: int, role: str) -> Id:
+        """
+        :param channel: channel index
+        :param payment: payment index in channel
+        :param role: one of ROLES
+        :return: identity for the role in the payment
+        """
+
+        return self.payment_node(channel, payment).child(ROLES.index(role)).to_id()
+
+
+class CounterpartyKeys:
+    """
+    Public keys of counterparty, derived from its channel xpub
+    """
+
+    def __init__(self, channel_xpub: str):
+        self.channel_node = HdNode.deserialize(channel_xpub)
+        if self.channel_node.is_private:
+            raise ValueError('expected extended public key')
+        self.payment_nodes: Dict[int, HdNode] = OrderedDict()
+
+    def get_public_key(self, payment: int, role: str) -> PublicKey:
+        node = self.payment_nodes.get(payment)
+        if node is None:
+            node = self.payment_nodes[payment] = self.channel_node.child(payment)
+            if len(self.payment_nodes) > PAYMENT_NODES_CACHE_SIZE:
+                self.payment_nodes.popitem(last=False)
+        else:
+            self.payment_nodes.move_to_end(payment)
+        return node.child(ROLES.index(role)).get_public_key()
+
+
+def test_bip32_vectors():
+    from bitcoinutils import setup
+    setup.setup('mainnet')
+
+    # test vector 1 of BIP32
+    root = HdNode.from_seed(bytes.fromhex('000102030405060708090a0b0c0d0e0f'))
+    assert root.serialize() == 'xprv9s21ZrQH143K3QTDL4LXw2F7HEK3wJUD2nW2nRk4stbPy6cq3jPPqjiChkVvvNKmPGJxWUtg6LnF5kejMRNNU3TGtRBeJgk33yuGBxrMPHi'
+    assert root.neuter().serialize() == 'xpub661MyMwAqRbcFtXgS5sYJABqqG9YLmC4Q1Rdap9gSE8NqtwybGhePY2gZ29ESFjqJoCu1Rupje8YtGqsefD265TMg7usUDFdp6W1EGMcet8'
+    vectors = [
+        ("m/0'", 'xprv9uHRZZhk6KAJC1avXpDAp4MDc3sQKNxDiPvvkX8Br5ngLNv1TxvUxt4cV1rGL5hj6KCesnDYUhd7oWgT11eZG7XnxHrnYeSvkzY7d2bhkJ7',
+         'xpub68Gmy5EdvgibQVfPdqkBBCHxA5htiqg55crXYuXoQRKfDBFA1WEjWgP6LHhwBZeNK1VTsfTFUHCdrfp1bgwQ9xv5ski8PX9rL2dZXvgGDnw'),
+        ("m/0'/1", None, 'xpub6ASuArnXKPbfEwhqN6e3mwBcDTgzisQN1wXN9BJcM47sSikHjJf3UFHKkNAWbWMiGj7Wf5uMash7SyYq527Hqck2AxYysAA7xmALppuCkwQ'),
+        ("m/0'/1/2'", None, 'xpub6D4BDPcP2GT577Vvch3R8wDkScZWzQzMMUm3PWbmWvVJrZwQY4VUNgqFJPMM3No2dFDFGTsxxpG5uJh7n7epu4trkrX7x7DogT5Uv6fcLW5'),
+        ("m/0'/1/2'/2", None, 'xpub6FHa3pjLCk84BayeJxFW2SP4XRrFd1JYnxeLeU8EqN3vDfZmbqBqaGJAyiLjTAwm6ZLRQUMv1ZACTj37sR62cfN7fe5JnJ7dh8zL4fiyLHV'),
+        ("m/0'/1/2'/2/1000000000", None, 'xpub6H1LXWLaKsWFhvm6RVpEL9P4KfRZSW7abD2ttkWP3SSQvnyA8FSVqNTEcYFgJS2UaFcxupHiYkro49S8yGasTvXEYBVPamhGW6cFJodrTHy'),
+    ]
+    for path, xprv, xpub in vectors:
+        node = root.derive(path)
+        assert xprv is None or node.serialize() == xprv, path
+        assert node.neuter().serialize() == xpub, path
+        assert HdNode.deserialize(xpub).serialize() == xpub, path
+
+    # public derivation from xpub gives public keys of private derivation
+    node = root.derive("m/0'")
+    assert HdNode.deserialize(node.neuter().serialize()).derive('m/1/2').public_key == node.derive('m/1/2').public_key
+
+    # counterparty derives public keys of node roles from channel xpub only
+    keys = NodeKeys(bytes(32))
+    counterparty = CounterpartyKeys(keys.channel_xpub(3))
+    for role in ROLES:
+        assert counterparty.get_public_key(5, role).to_hex() == keys.get_id(3, 5, role).public_key.to_hex()
@@ -1,8 +1,15 @@
 import binascii
+import hashlib
+from typing import Tuple
+
 import base58
+from ecdsa import BadSignatureError, SECP256k1, VerifyingKey
+
+from bitcoinutils.keys import PrivateKey, PublicKey, P2pkhAddress
+from bitcoinutils.script import Script
+from bitcoinutils.transactions import Transaction, TxInput
 
-from bitcoinutils.keys import PrivateKey, P2pkhAddress
-from bitcoinutils.transactions import Transaction
+LOCKTIME_THRESHOLD = 500000000  # locktime below: block height, above: unix time
 
 
 class Id:
@@ -14,6 +21,67 @@ class Id:
         # print(self.private_key.to_wif(), self.address)
 
 
+class RawScript(Script):
+    """Script given by its serialization, for example lock script received from another process"""
+
+    def __init__(self, raw: bytes):
+        super().__init__([])
+        self.raw = raw
+
+    def to_bytes(self) -> bytes:
+        return self.raw
+
+
+def copy_tx_input(tx_in: TxInput) -> TxInput:
+    """
+    Input that spends the same output with empty script_sig. Signing writes script_sig into inputs of a transaction,
+    so transactions get their own copies and inputs passed by the caller stay unchanged and can be reused
+    """
+
+    return TxInput(tx_in.txid, tx_in.txout_index, sequence=tx_in.sequence)
+
+
+def hash160(data: bytes) -> bytes:
+    sha = hashlib.sha256(data).digest()
+    try:
+        return hashlib.new('ripemd160', sha).digest()
+    except ValueError:
+        from bitcoinutils.ripemd160 import ripemd160
+        return ripemd160(sha)
+
+
+def decode_der_signature(sig: bytes) -> Tuple[int, int]:
+    # lax DER parsing: padded integers are accepted, as some signers leave a zero byte in front of low S
+    if len(sig) < 8 or sig[0] != 0x30 or sig[2] != 0x02:
+        raise ValueError('invalid DER signature')
+    len_r = sig[3]
+    r = int.from_bytes(sig[4:4 + len_r], 'big')
+    if sig[4 + len_r] != 0x02:
+        raise ValueError('invalid DER signature')
+    len_s = sig[5 + len_r]
+    s = int.from_bytes(sig[6 + len_r:6 + len_r + len_s], 'big')
+    return r, s
+
+
+def verify_input_signature(tx: Transaction, index: int, script: Script, pubkey: PublicKey, signature: str) -> bool:
+    """
+    :param tx: transaction with signed input
+    :param index: index of signed input
+    :param script: lock script of spent output
+    :param pubkey: public key of signer
+    :param signature: hex signature with sighash byte, as returned by PrivateKey.sign_input
+    :return: signature is valid for the input
+    """
+
+    try:
+        sig = bytes.fromhex(signature)
+        digest = tx.get_transaction_digest(index, script, sig[-1])
+        key = VerifyingKey.from_string(bytes.fromhex(pubkey.to_hex()), curve=SECP256k1)
+        return key.verify_digest(decode_der_signature(sig[:-1]), digest, sigdecode=lambda rs, order: rs)
+    except (BadSignatureError, ValueError, IndexError, AssertionError):
+        return False
+
+
 def wif_to_private_key(wif: str):
     first_encode = base58.b58decode(wif)
     private_key_full = binascii.hexlify(first_encode)
@@ -0,0 +1,477 @@
+import os
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from bitcoinutils import setup
+from bitcoinutils.constants import TYPE_RELATIVE_TIMELOCK
+from bitcoinutils.keys import PublicKey
+from bitcoinutils.transactions import Sequence, Transaction, TxInput
+
+from channel import getChannelLockScript, getChannelStateScriptSigLeft, getChannelStateScriptSigRight, signChannelStateTx
+from funding import FundingUtxo, UtxoPool
+from hd_keys import LEFT_ROLES, RIGHT_ROLES, ROLES, CounterpartyKeys, NodeKeys
+from helper import Id
+from rapid_transactions import getTxStateLockScript, createTxState, createEnableTx, signEnableTx, createTxRefund, \
+    txRefundGetRightSignature, signTxRefundStateInput, createTxInstPay, signTxInstPayStateInput, createTxPayAndSign
+from sim_chain import SimChain
+
+
+class PaymentIds:
+    """
+    Identities of one user for all roles of one payment, never reused by another payment.
+    With node keys the user has private keys only for its own roles (hd_keys.LEFT_ROLES or RIGHT_ROLES)
+    and public keys of counterparty roles are derived from counterparty channel xpub, so no keys are exchanged
+    for a payment. Without node keys all roles get random private keys, for a single party playing both sides
+    """
+
+    def __init__(self, node_keys: Optional[NodeKeys] = None, counterparty_keys: Optional[CounterpartyKeys] = None,
+                 side: str = 'left', channel: int = 0, payment: int = 0):
+        """
+        :param node_keys: keys of this user
+        :param counterparty_keys: keys of counterparty, required with node_keys
+        :param side: 'left' or 'right', role of this user in the channel
+        :param channel: channel index in node_keys
+        :param payment: payment index, same for both users
+        """
+
+        self.ids: Dict[str, Id] = {}
+        self.public_keys: Dict[str, PublicKey] = {}
+        if node_keys is None:
+            for role in ROLES:
+                self.ids[role] = Id(os.urandom(32).hex())
+        else:
+            if counterparty_keys is None:
+                raise ValueError('counterparty keys are required with node keys')
+            if side not in ('left', 'right'):
+                raise ValueError(f'unknown side {side}')
+            own_roles = LEFT_ROLES if side == 'left' else RIGHT_ROLES
+            for role in ROLES:
+                if role in own_roles:
+                    self.ids[role] = node_keys.get_id(channel, payment, role)
+                else:
+                    self.public_keys[role] = counterparty_keys.get_public_key(payment, role)
+        for role, id in self.ids.items():
+            self.public_keys[role] = id.public_key
+
+    def get_id(self, role: str) -> Id:
+        id = self.ids.get(role)
+        if id is None:
+            raise ValueError(f'{role} is a role of counterparty')
+        return id
+
+    def get_public_key(self, role: str) -> PublicKey:
+        return self.public_keys[role]
+
+
+class LadderEntry(NamedTuple):
+    sequence: int  # channel state the entry was built for
+    lock_amount: int
+    ids_left: PaymentIds
+    ids_right: PaymentIds
+    er_funding: FundingUtxo
+    ep_funding: FundingUtxo
+    tx_er: Transaction
+    tx_ep: Transaction
+    tx_state: Transaction
+    tx_refund: Transaction
+    tx_inst_pay: Transaction
+    tx_pay: Transaction
+
+
+def buildPayment(id_channel_left: Id, id_channel_right: Id, tx_channel_input: TxInput, balance_left: int, balance_right: int,
+                 lock_amount: int, er_funding: FundingUtxo, ep_funding: FundingUtxo,
+                 T: int, delta: int, t_channel: int, eps: int, fee: int, sequence: int = 0,
+                 ids_left: Optional[PaymentIds] = None, ids_right: Optional[PaymentIds] = None) -> LadderEntry:
+    """
+    Build and co-sign tx_state of a payment together with its enable transactions and refund, pay and inst-pay children
+
+    :param id_channel_left: left id of channel 2/2 multisig
+    :param id_channel_right: right id of channel 2/2 multisig
+    :param tx_channel_input: reference to channel open transaction
+    :param balance_left: coins of left user before the payment: 'a'
+    :param balance_right: coins of right user before the payment: 'b'
+    :param lock_amount: coins to lock: 'c'
+    :param er_funding: output that funds enable-refund transaction
+    :param ep_funding: output that funds enable-payment transaction
+    :param T: locked funds can pe paid after this time wherever right user wants
+    :param delta: upper bound on time for transaction to be confirmed by the network
+    :param t_channel: upper bound for closing a channel
+    :param eps: value of enable transactions outputs
+    :param fee: coins paid to miners by refund, pay and inst-pay transactions
+    :param sequence: channel state the payment is built for
+    :param ids_left: identities of left user, random by default
+    :param ids_right: identities of right user, same as ids_left by default
+    :return: payment with all transactions signed
+    """
+
+    if ids_left is None:
+        ids_left = PaymentIds()
+    if ids_right is None:
+        ids_right = ids_left
+    for role in ROLES:
+        if ids_left.get_public_key(role).to_hex() != ids_right.get_public_key(role).to_hex():
+            raise ValueError(f'users derived different public keys for {role}')
+    key = ids_left.get_public_key
+    tx_er_rel_timelock = t_channel + 2 * delta
+    tx_ep_rel_timelock = t_channel
+
+    tx_er = signEnableTx(createEnableTx(er_funding.tx_in, [key('er_owner')], tx_er_rel_timelock, eps), er_funding.owner)
+    tx_ep = signEnableTx(createEnableTx(ep_funding.tx_in, [key('ep_owner')], tx_ep_rel_timelock, eps), ep_funding.owner)
+
+    state_lock_script = getTxStateLockScript(T, delta, key('pay_right'), key('refund_mulsig_left'), key('refund_mulsig_right'),
+                                             key('pay_mulsig_left'), key('pay_mulsig_right'))
+    tx_state = createTxState(tx_channel_input, key('state_left'), key('state_right'), key('pay_right'),
+                             key('refund_mulsig_left'), key('refund_mulsig_right'), key('pay_mulsig_left'), key('pay_mulsig_right'),
+                             lock_amount, balance_left - lock_amount, balance_right, T, delta)
+    sig_tx_state_left = getChannelStateScriptSigLeft(tx_state, id_channel_left, id_channel_right.public_key)
+    sig_tx_state_right = getChannelStateScriptSigRight(tx_state, id_channel_right, id_channel_left.public_key)
+    tx_state = signChannelStateTx(tx_state, sig_tx_state_left, sig_tx_state_right)
+
+    tx_state_lock_input = TxInput(tx_state.get_txid(), 0, sequence=Sequence(TYPE_RELATIVE_TIMELOCK, delta).for_input_sequence())
+    tx_er_input = TxInput(tx_er.get_txid(), 0, sequence=Sequence(TYPE_RELATIVE_TIMELOCK, tx_er_rel_timelock).for_input_sequence())
+    tx_ep_input = TxInput(tx_ep.get_txid(), 0, sequence=Sequence(TYPE_RELATIVE_TIMELOCK, tx_ep_rel_timelock).for_input_sequence())
+
+    tx_refund, sig_left = createTxRefund(tx_er_input, tx_state_lock_input, ids_left.get_id('er_owner'),
+                                         ids_left.get_id('refund_mulsig_left'), state_lock_script,
+                                         ids_left.get_id('refund_receiver'), lock_amount, fee, eps, tx_er_rel_timelock)
+    sig_right = txRefundGetRightSignature(tx_refund, ids_right.get_id('refund_mulsig_right'), state_lock_script)
+    tx_refund = signTxRefundStateInput(tx_refund, sig_left, sig_right)
+
+    inst_pay_lock_script = key('inst_pay_receiver').get_address().to_script_pub_key()
+    tx_inst_pay, sig_state_left = createTxInstPay(tx_ep_input, tx_state_lock_input, ids_left.get_id('pay_mulsig_left'),
+                                                  state_lock_script, inst_pay_lock_script, lock_amount, fee, eps)
+    tx_inst_pay = signTxInstPayStateInput(tx_inst_pay, sig_state_left, ids_right.get_id('ep_owner'),
+                                          ids_right.get_id('pay_mulsig_right'), state_lock_script, tx_ep_rel_timelock)
+
+    tx_pay = createTxPayAndSign(tx_state_lock_input, ids_right.get_id('pay_right'), state_lock_script,
+                                ids_right.get_id('pay_receiver'), lock_amount, fee, T)
+
+    return LadderEntry(sequence, lock_amount, ids_left, ids_right, er_funding, ep_funding,
+                       tx_er, tx_ep, tx_state, tx_refund, tx_inst_pay, tx_pay)
+
+
+class StateLadder:
+    """
+    Opt-in mode for channels with predictable traffic: a background thread builds and co-signs payments
+    for standard lock amounts ahead of time, so take() serves a payment without any signing.
+
+    The ladder signs for both users, so it needs channel keys and node keys of both of them: it is a construct
+    for a single operator of both sides of a channel, or for tests. Two separate users build their own halves
+    of an entry (see PaymentIds) and exchange signatures online instead.
+
+    Entries are built for the current channel state only. When the state changes (a payment is served or
+    settled) other entries become stale, but their co-signed tx_state can not be revoked: either user can
+    still publish it instead of the current state. This is a risk for right user: left can publish a stale
+    tx_state built before payments to right were settled, refund its locked coins and undo those payments.
+    Stale entries are kept with their funding outputs, keys and signed enable and refund transactions, so left
+    can refund if right publishes one. Co-signed unused tx_states (prepared and stale) are capped by max_unused,
+    at the cap the ladder stops building until the channel output is moved to a new one (on_channel_moved()),
+    which invalidates all of them and returns their funding outputs to the pool, or spent (on_channel_spent()).
+    Deeper ladder serves more payments without signing, but keeps more funding outputs out of the pool
+    """
+
+    def __init__(self, id_channel_left: Id, id_channel_right: Id, tx_channel_input: TxInput,
+                 balance_left: int, balance_right: int, pool: UtxoPool, amounts: List[int],
+                 T: int, delta: int, t_channel: int, eps: int, fee: int, depth: int = 1,
+                 keys_left: Optional[NodeKeys] = None, keys_right: Optional[NodeKeys] = None,
+                 channel: int = 0, first_payment: int = 0, max_unused: Optional[int] = None):
+        """
+        :param pool: pre-funded outputs for enable transactions, value at least <eps> each
+        :param amounts: standard lock amounts to prepare payments for
+        :param depth: number of prepared payments for each amount
+        :param max_unused: maximal number of co-signed tx_states that are prepared or stale, twice the number
+        of prepared entries by default. Bigger value serves more payments before on_channel_moved(), but
+        gives more old states left user can publish
+        :param keys_left: derive identities of left user from its node seed instead of random keys
+        :param keys_right: same for right user, required with keys_left
+        :param channel: channel index for derivation paths
+        :param first_payment: index of first payment for derivation paths. Keys are not reused only if
+        ladder.payments is stored and passed here when the ladder is created again for the channel
+        Other parameters are same as in buildPayment
+        """
+
+        if (keys_left is None) != (keys_right is None):
+            raise ValueError('node keys are required for both users or none')
+
+        self.id_channel_left = id_channel_left
+        self.id_channel_right = id_channel_right
+        self.tx_channel_input = tx_channel_input
+        self.balance_left = balance_left
+        self.balance_right = balance_right
+        self.locked = 0
+        self.sequence = 0
+        self.pool = pool
+        self.amounts = amounts
+        self.T = T
+        self.delta = delta
+        self.t_channel = t_channel
+        self.eps = eps
+        self.fee = fee
+        self.depth = depth
+        self.max_unused = max_unused if max_unused is not None else 2 * depth * len(amounts)
+        self.keys_left = keys_left
+        self.keys_right = keys_right
+        if keys_left is not None:
+            self.counterparty_left = CounterpartyKeys(keys_left.channel_xpub(channel))  # left user as seen by right
+            self.counterparty_right = CounterpartyKeys(keys_right.channel_xpub(channel))
+        self.channel = channel
+        self.payments = first_payment  # index of next payment for derivation paths
+
+        self.entries: Dict[int, List[LadderEntry]] = {amount: [] for amount in amounts}
+        self.stale: Dict[str, LadderEntry] = {}  # tx_state txid -> co-signed entry of an old channel state
+        self.closed = False  # channel output is spent
+        self.error: Optional[Exception] = None  # last error of building an entry
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self.running = True
+        self.thread = threading.Thread(target=self._fill, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _unused(self) -> int:
+        return len(self.stale) + sum(len(entries) for entries in self.entries.values())
+
+    def _missing(self) -> Optional[int]:
+        if self.locked or self.closed or self._unused() >= self.max_unused or self.pool.count_at_least(self.eps) < 2:
+            return None
+        for amount in self.amounts:
+            if amount <= self.balance_left and len(self.entries[amount]) < self.depth:
+                return amount
+        return None
+
+    def _take_funding(self) -> Optional[Tuple[FundingUtxo, FundingUtxo]]:
+        # pool has its own lock and may be used from outside, so outputs counted by _missing() can be gone
+        try:
+            er_funding = self.pool.take_at_least(self.eps)
+        except KeyError:
+            return None
+        try:
+            ep_funding = self.pool.take_at_least(self.eps)
+        except KeyError:
+            self.pool.add(er_funding)
+            return None
+        return er_funding, ep_funding
+
+    def _fill(self) -> None:
+        while True:
+            with self.condition:
+                amount = funding = None
+                while self.running and funding is None:
+                    amount = self._missing()
+                    if amount is not None:
+                        funding = self._take_funding()
+                    if funding is None:
+                        self.condition.wait(timeout=1)  # pool may be refilled from outside
+                if not self.running:
+                    if funding is not None:
+                        self.pool.add(funding[0])
+                        self.pool.add(funding[1])
+                    return
+                sequence = self.sequence
+                balance_left, balance_right = self.balance_left, self.balance_right
+                er_funding, ep_funding = funding
+                payment = self.payments
+                self.payments += 1
+
+            try:
+                if self.keys_left is None:
+                    ids_left = ids_right = PaymentIds()
+                else:
+                    ids_left = PaymentIds(self.keys_left, self.counterparty_right, 'left', self.channel, payment)
+                    ids_right = PaymentIds(self.keys_right, self.counterparty_left, 'right', self.channel, payment)
+                entry = buildPayment(self.id_channel_left, self.id_channel_right, self.tx_channel_input, balance_left, balance_right,
+                                     amount, er_funding, ep_funding, self.T, self.delta, self.t_channel, self.eps, self.fee,
+                                     sequence, ids_left, ids_right)
+            except Exception as e:
+                # nothing was published, so funding outputs can be used again
+                with self.condition:
+                    self.pool.add(er_funding)
+                    self.pool.add(ep_funding)
+                    self.error = e
+                    self.condition.wait(timeout=1)
+                continue
+
+            with self.condition:
+                if sequence == self.sequence and not self.closed:
+                    self.entries[amount].append(entry)
+                else:
+                    self._discard(entry)
+
+    def _release(self, entry: LadderEntry) -> None:
+        self.pool.add(entry.er_funding)
+        self.pool.add(entry.ep_funding)
+
+    def _discard(self, entry: LadderEntry) -> None:
+        tx_in = entry.tx_state.inputs[0]
+        if self.closed or (tx_in.txid, tx_in.txout_index) != (self.tx_channel_input.txid, self.tx_channel_input.txout_index):
+            # spends an output that is already spent, so it can never be published
+            self._release(entry)
+        else:
+            self.stale[entry.tx_state.get_txid()] = entry
+
+    def _advance(self) -> None:
+        self.sequence += 1
+        for amount, entries in self.entries.items():
+            for entry in entries:
+                self._discard(entry)
+            entries.clear()
+        self.condition.notify_all()
+
+    def take(self, lock_amount: int) -> Optional[LadderEntry]:
+        """
+        Serve a payment from the ladder and move channel to the state of its tx_state
+
+        :param lock_amount: coins to lock
+        :return: prepared payment, None if there is no one for this amount. Then payment should be built online
+        """
+
+        with self.condition:
+            entries = self.entries.get(lock_amount)
+            if self.locked or self.closed or not entries:
+                return None
+            entry = entries.pop()
+            self.balance_left -= lock_amount
+            self.locked = lock_amount
+            self._advance()
+            return entry
+
+    def settle(self, paid: bool) -> None:
+        """
+        :param paid: locked coins went to right user, otherwise they are refunded to left
+        """
+
+        with self.condition:
+            if not self.locked:
+                raise ValueError('no payment to settle')
+            if paid:
+                self.balance_right += self.locked
+            else:
+                self.balance_left += self.locked
+            self.locked = 0
+            self._advance()
+
+    def on_channel_moved(self, tx_channel_input: TxInput) -> None:
+        """
+        Channel coins are moved with current balances to a new 2/2 multisig output by a confirmed transaction
+        co-signed by both users. No tx_state of the ladder can be published anymore, so all prepared and stale
+        entries are dropped, their funding outputs go back to the pool and the ladder builds for the new output
+
+        :param tx_channel_input: reference to the new channel output
+        """
+
+        with self.condition:
+            if self.locked:
+                raise ValueError('payment is not settled')
+            if self.closed:
+                raise ValueError('channel is closed')
+            self.tx_channel_input = tx_channel_input
+            for entry in self.stale.values():
+                self._release(entry)
+            self.stale.clear()
+            self._advance()
+
+    def on_channel_spent(self, txid: str) -> Optional[LadderEntry]:
+        """
+        Channel output is spent by a confirmed transaction, so no other tx_state of the ladder can be published.
+        Ladder stops building entries, funding outputs of all entries except the published one go back to the pool
+
+        :param txid: transaction that spent channel output
+        :return: entry whose tx_state was published, None if it is not built by the ladder (for example, a served entry).
+        Left user should publish its tx_er and tx_refund, see claims.refundClaim
+        """
+
+        with self.condition:
+            for amount, entries in self.entries.items():
+                for entry in entries:
+                    self._discard(entry)
+                entries.clear()
+            self.closed = True  # entries still being built are released by _discard()
+            self.condition.notify_all()
+            published = self.stale.pop(txid, None)
+            for entry in self.stale.values():
+                self._release(entry)
+            self.stale.clear()
+            return published
+
+
+def test_state_ladder():
+    def waitFor(condition) -> None:
+        deadline = time.monotonic() + 30
+        while not condition():
+            assert time.monotonic() < deadline, 'ladder is not filled in time'
+            time.sleep(0.05)
+
+    setup.setup('testnet')
+    T, delta, t_channel, eps, fee = 1200, 10, 35, 200, 100
+    chain = SimChain(height=1000)
+    id_left, id_right, id_funding = Id(os.urandom(32).hex()), Id(os.urandom(32).hex()), Id(os.urandom(32).hex())
+    tx_channel_input = chain.fund(getChannelLockScript(id_left.public_key, id_right.public_key), 20000)
+
+    # outputs below eps can not fund enable transactions, filler waits instead of failing
+    pool = UtxoPool()
+    for _ in range(2):
+        pool.add(FundingUtxo(chain.fund(id_funding.p2pkh, 10), 10, id_funding))
+    keys_left, keys_right = NodeKeys(os.urandom(32)), NodeKeys(os.urandom(32))
+    ladder = StateLadder(id_left, id_right, tx_channel_input, 10000, 10000, pool, [500, 1000], T, delta, t_channel, eps, fee,
+                         keys_left=keys_left, keys_right=keys_right, first_payment=7)
+    ladder.start()
+    time.sleep(0.2)
+    assert ladder.thread.is_alive() and len(pool) == 2 and ladder.take(500) is None
+
+    for _ in range(4):
+        pool.add(FundingUtxo(chain.fund(id_funding.p2pkh, 1000), 1000, id_funding))
+    waitFor(lambda: all(ladder.entries.values()))
+    entry = ladder.take(500)
+    assert entry is not None
+    ladder.stop()
+    # each user holds only its own keys, payment indexes continue from first_payment
+    payment = next(p for p in range(7, ladder.payments) if
+                   keys_left.get_id(0, p, 'er_owner').address == entry.ids_left.get_id('er_owner').address)
+    assert ladder.payments >= 9 and 'er_owner' not in entry.ids_right.ids and 'pay_right' not in entry.ids_left.ids
+    assert entry.ids_left.get_public_key('pay_right').to_hex() == keys_right.get_id(0, payment, 'pay_right').public_key.to_hex()
+    assert len(ladder.stale) == 1 and len(pool) == 2  # funding of stale entry is kept
+
+    # counterparty publishes stale tx_state: left still refunds with the kept entry
+    stale = next(iter(ladder.stale.values()))
+    chain.broadcast(stale.tx_state)
+    chain.mine()
+    assert ladder.on_channel_spent(stale.tx_state.get_txid()) is stale
+    chain.broadcast(stale.tx_er)
+    chain.mine(t_channel + 2 * delta)
+    chain.broadcast(stale.tx_refund)
+    chain.mine()
+    assert chain.confirmations(stale.tx_refund.get_txid()) == 1
+
+    # co-signed unused states are capped, so funding does not leak while payments are served and settled
+    pool = UtxoPool()
+    for _ in range(40):
+        pool.add(FundingUtxo(chain.fund(id_funding.p2pkh, 1000), 1000, id_funding))
+    ladder = StateLadder(id_left, id_right, tx_channel_input, 10000, 10000, pool, [500, 1000], T, delta, t_channel, eps, fee)
+    ladder.start()
+    for served in range(1, 7):
+        waitFor(lambda: ladder.entries[500])
+        assert ladder.take(500) is not None
+        ladder.settle(paid=True)
+        assert ladder._unused() <= ladder.max_unused == 4
+    ladder.stop()
+    assert len(pool) + 2 * (ladder._unused() + served) == 40
+
+    # moving channel to a new output invalidates all unused states and releases their funding
+    tx_channel_input = chain.fund(getChannelLockScript(id_left.public_key, id_right.public_key), 20000)
+    ladder.on_channel_moved(tx_channel_input)
+    assert ladder._unused() == 0 and len(pool) == 40 - 2 * served
+    ladder.start()
+    waitFor(lambda: ladder.entries[500])
+    assert ladder.take(500).tx_state.inputs[0].txid == tx_channel_input.txid
+    ladder.stop()
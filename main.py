@@ -1,8 +1,13 @@
+import time
+from typing import List, Optional
+
 from bitcoinutils.utils import to_satoshis
 
 from rapid_transactions import *
 from channel import *
+from funding import FundingUtxo, createSplitTx, signSplitTx
 from helper import Id, print_tx, wif_to_private_key
+from sim_chain import SimChain, TxRejected
 
 
 def main():
@@ -114,7 +119,7 @@ def main():
     tx_refund_id = '98c5369111480b3fbac3e4ab1fd9d05f8dcdb19d20562aff21c3602f34be5882'
 
     tx_pay = createTxPayAndSign(tx_state_lock_input, id_pay_right, state_lock_script, id_pay_receiver,
-                                lock_amount, to_satoshis(0.00000600))
+                                lock_amount, to_satoshis(0.00000600), T)
     print_tx(tx_pay, 'tx pay')
     # 197 bytes
 
@@ -134,14 +139,10 @@ def split_funds():
     id2 = Id('f74b11ae3ca8d2c2d0424296f0de316198b4fda2ca984b5e3c6681abd2c72b2c')
     id3 = Id('f2b019b04121adca7b6541a08761454b14ffd705248a51e7f3b6cfbf64f2b26b')
     id4 = Id('89270091320614b25f88b84497ff4e4a017cbf1d25c1462b1352ea44f45708db')
-    out1 = TxOutput(to_satoshis(0.0000115), id1.p2pkh)
-    out2 = TxOutput(to_satoshis(0.0000115), id2.p2pkh)
-    out3 = TxOutput(to_satoshis(0.0000115), id3.p2pkh)
-    out4 = TxOutput(to_satoshis(0.0000115), id4.p2pkh)
-
-    tx = Transaction([tx_input], [out1, out2, out3, out4])
-    sign = id_in.private_key.sign_input(tx, 0, id_in.p2pkh)
-    tx_input.script_sig = Script([sign, id_in.public_key.to_hex()])
+    source = FundingUtxo(tx_input, to_satoshis(0.0000500), id_in)  # amount is used only by planSplitTxs
+
+    tx = createSplitTx([source], [id1, id2, id3, id4], to_satoshis(0.0000115))
+    tx = signSplitTx(tx, [source])
     print_tx(tx)
 
 
@@ -162,10 +163,226 @@ def test_rel_lock():
     print_tx(tx)
 
 
+SIM_EPS = 200
+SIM_DELTA = 10
+SIM_T = 2100200
+SIM_T_CHANNEL = 35
+SIM_FEE = 100
+
+
+class SimIds:
+    """Constant identities of simulated payments, built once: creating an Id costs more than validating a transaction"""
+
+    def __init__(self):
+        self.in_channel_left = Id('616c26241bb007883f13aff556bb07d28374b52b81aa675f30dcf35c04103da4')
+        self.in_channel_right = Id('f74b11ae3ca8d2c2d0424296f0de316198b4fda2ca984b5e3c6681abd2c72b2c')
+        self.channel_left = Id('e6ad38d70bf775e7e74bcd598e9282141dac09f79374565c3ebdf61e4f9ef4ed')
+        self.channel_right = Id('a3dbcea1e46edecbd1da13231f385ebe7f2beea382e3f7227c4c00d21b7e8455')
+        self.ep_in = Id('f2b019b04121adca7b6541a08761454b14ffd705248a51e7f3b6cfbf64f2b26b')
+        self.er_in = Id('89270091320614b25f88b84497ff4e4a017cbf1d25c1462b1352ea44f45708db')
+        self.er_u1 = Id('3223c869874bad6933f14d1bf3bc9354125641e0aef3484dcf313c24a18655c7')
+        self.ep_u1 = Id('d0f7165a36f496ff7599add67e7152869ee0e515bab290c4b77a559623034c82')
+        self.state_left = Id('ce7bca0ec8d38f945390e64627f4b669eca9afd2bae77d036421ce96b6767728')
+        self.state_right = Id('ad5813d9719179da0e561aa22295017559b247a3bb325ce438bc8247bf79962e')
+        self.refund_mulsig_left = Id('e34d37fdeb88addac291ae0fa084f33490d756d8298e7219b0d4f073616dd251')
+        self.refund_mulsig_right = Id('4d87652d513e0f7a5be51894b7fa862c8ca3ea8ef222f6b6ea7ed6a949f67672')
+        self.pay_mulsig_left = Id('0a08c11255f48d66b0d1dcab0e3b9479a7e1275d078663fde3dc9fd92355e784')
+        self.pay_mulsig_right = self.pay_mulsig_left
+        self.pay_right = self.pay_mulsig_left
+        self.receiver = Id('e2bd3bf28c7e0994ef87a8d61b67f4f926ab2e315bc9f1e55da2394a594b4e66')
+
+
+_sim_ids: Optional[SimIds] = None
+
+
+def getSimIds() -> SimIds:
+    global _sim_ids
+    if _sim_ids is None:
+        _sim_ids = SimIds()
+    return _sim_ids
+
+
+def signSimulation(outcome: str = 'refund') -> List[tuple]:
+    """
+    Sign transactions of channel open -> tx_state -> enable tx -> refund / pay / inst-pay once. Funding outputs
+    of a new SimChain are always the same, so the transactions are valid on every new chain
+
+    :param outcome: how the locked coins are claimed: 'refund', 'pay' or 'inst_pay'
+    :return: steps for simulate(): ('fund', script_pubkey, amount), ('broadcast', tx), ('mine', blocks) or ('mine_until', height)
+    """
+
+    if outcome not in ('refund', 'pay', 'inst_pay'):
+        raise ValueError(f'unknown outcome {outcome}')
+    ids = getSimIds()
+    tx_er_rel_timelock = SIM_T_CHANNEL + 2 * SIM_DELTA
+    tx_ep_rel_timelock = SIM_T_CHANNEL
+    chain = SimChain()  # only gives funding outputs
+    steps = []
+
+    def fund(script_pubkey: Script, amount: int) -> TxInput:
+        steps.append(('fund', script_pubkey, amount))
+        return chain.fund(script_pubkey, amount)
+
+    tx_in_channel_left = fund(ids.in_channel_left.p2pkh, 1150)
+    tx_in_channel_right = fund(ids.in_channel_right.p2pkh, 1150)
+    tx_ep_input = fund(ids.ep_in.p2pkh, 1150)
+    tx_er_input = fund(ids.er_in.p2pkh, 1150)
+
+    tx_channel = createOpenChannelTx(tx_in_channel_left, tx_in_channel_right, 900, 900,
+                                     ids.channel_left.public_key, ids.channel_right.public_key)
+    tx_channel = signOpenChannelTxLeft(tx_channel, ids.in_channel_left)
+    tx_channel = signOpenChannelTxRight(tx_channel, ids.in_channel_right)
+    steps += [('broadcast', tx_channel), ('mine', 1)]
+
+    state_lock_script = getTxStateLockScript(SIM_T, SIM_DELTA, ids.pay_right.public_key,
+                                             ids.refund_mulsig_left.public_key, ids.refund_mulsig_right.public_key,
+                                             ids.pay_mulsig_left.public_key, ids.pay_mulsig_right.public_key)
+    lock_amount = 500
+    tx_state = createTxState(TxInput(tx_channel.get_txid(), 0), ids.state_left.public_key, ids.state_right.public_key,
+                             ids.pay_right.public_key, ids.refund_mulsig_left.public_key, ids.refund_mulsig_right.public_key,
+                             ids.pay_mulsig_left.public_key, ids.pay_mulsig_right.public_key,
+                             lock_amount, 800, 400, SIM_T, SIM_DELTA)
+    sig_tx_state_left = getChannelStateScriptSigLeft(tx_state, ids.channel_left, ids.channel_right.public_key)
+    sig_tx_state_right = getChannelStateScriptSigRight(tx_state, ids.channel_right, ids.channel_left.public_key)
+    tx_state = signChannelStateTx(tx_state, sig_tx_state_left, sig_tx_state_right)
+    steps += [('broadcast', tx_state), ('mine', 1)]
+
+    tx_state_lock_input = TxInput(tx_state.get_txid(), 0, sequence=Sequence(TYPE_RELATIVE_TIMELOCK, SIM_DELTA).for_input_sequence())
+
+    if outcome == 'refund':
+        tx_er = signEnableTx(createEnableTx(tx_er_input, [ids.er_u1.public_key], tx_er_rel_timelock, SIM_EPS), ids.er_in)
+        steps += [('broadcast', tx_er), ('mine', tx_er_rel_timelock)]
+
+        tx_er_for_refund_input = TxInput(tx_er.get_txid(), 0,
+                                         sequence=Sequence(TYPE_RELATIVE_TIMELOCK, tx_er_rel_timelock).for_input_sequence())
+        tx_refund, sig_left = createTxRefund(tx_er_for_refund_input, tx_state_lock_input, ids.er_u1, ids.refund_mulsig_left,
+                                             state_lock_script, ids.receiver, lock_amount, SIM_FEE, SIM_EPS, tx_er_rel_timelock)
+        sig_right = txRefundGetRightSignature(tx_refund, ids.refund_mulsig_right, state_lock_script)
+        steps.append(('broadcast', signTxRefundStateInput(tx_refund, sig_left, sig_right)))
+    elif outcome == 'inst_pay':
+        tx_ep = signEnableTx(createEnableTx(tx_ep_input, [ids.ep_u1.public_key], tx_ep_rel_timelock, SIM_EPS), ids.ep_in)
+        steps += [('broadcast', tx_ep), ('mine', tx_ep_rel_timelock)]
+
+        tx_ep_for_inst_pay_input = TxInput(tx_ep.get_txid(), 0,
+                                           sequence=Sequence(TYPE_RELATIVE_TIMELOCK, tx_ep_rel_timelock).for_input_sequence())
+        tx_inst_pay, sig_state_left = createTxInstPay(tx_ep_for_inst_pay_input, tx_state_lock_input, ids.pay_mulsig_left,
+                                                      state_lock_script, ids.receiver.p2pkh, lock_amount, SIM_FEE, SIM_EPS)
+        steps.append(('broadcast', signTxInstPayStateInput(tx_inst_pay, sig_state_left, ids.ep_u1, ids.pay_mulsig_right,
+                                                           state_lock_script, tx_ep_rel_timelock)))
+    else:
+        steps.append(('mine_until', SIM_T))
+        steps.append(('broadcast', createTxPayAndSign(tx_state_lock_input, ids.pay_right, state_lock_script, ids.receiver,
+                                                      lock_amount, SIM_FEE, SIM_T)))
+    steps.append(('mine', 1))
+    return steps
+
+
+def simulate(outcome: str = 'refund', verify_signatures: bool = True, steps: Optional[List[tuple]] = None) -> SimChain:
+    """
+    Replay channel open -> tx_state -> enable tx -> refund / pay / inst-pay on a simulated chain instead of testnet
+
+    :param outcome: how the locked coins are claimed: 'refund', 'pay' or 'inst_pay'
+    :param verify_signatures: check ECDSA signatures in the simulated chain
+    :param steps: result of signSimulation(outcome), to not sign the transactions again
+    :return: chain after the locked coins are claimed
+    """
+
+    if steps is None:
+        setup.setup('testnet')
+        steps = signSimulation(outcome)
+    chain = SimChain(height=SIM_T - 200, verify_signatures=verify_signatures)
+    for step in steps:
+        if step[0] == 'fund':
+            chain.fund(step[1], step[2])
+        elif step[0] == 'broadcast':
+            chain.broadcast(step[1])
+        elif step[0] == 'mine':
+            chain.mine(step[1])
+        else:
+            chain.mine_until(step[1])
+    return chain
+
+
+def simulate_load(runs: int = 1000, verify_signatures: bool = False):
+    setup.setup('testnet')
+    for outcome in ['refund', 'pay', 'inst_pay']:
+        steps = signSimulation(outcome)
+        start = time.perf_counter()
+        for _ in range(runs):
+            simulate(outcome, verify_signatures, steps)
+        elapsed = time.perf_counter() - start
+        print(f'{outcome}: {runs} payments in {elapsed:.2f}s, {elapsed / runs * 1000:.2f} ms per payment')
+
+
+def test_sim_chain_timelocks():
+    setup.setup('testnet')
+    delta = 10
+    T = 2100200
+    rel_timelock = 35
+    fee = 100
+
+    def assertRejected(chain: SimChain, tx: Transaction, reason: str) -> None:
+        try:
+            chain.broadcast(tx)
+        except TxRejected as e:
+            assert reason in str(e), f'rejected with "{e}", expected "{reason}"'
+        else:
+            raise AssertionError(f'transaction accepted, expected "{reason}"')
+
+    for outcome in ['refund', 'pay', 'inst_pay']:
+        steps = signSimulation(outcome)
+        for _ in range(2):  # signed once, valid on every new chain
+            simulate(outcome, steps=steps)
+
+    chain = SimChain(height=T - 100)
+    id_ep_in = Id('f2b019b04121adca7b6541a08761454b14ffd705248a51e7f3b6cfbf64f2b26b')
+    id_ep_u1 = Id('d0f7165a36f496ff7599add67e7152869ee0e515bab290c4b77a559623034c82')
+    id_pay_right = Id('0a08c11255f48d66b0d1dcab0e3b9479a7e1275d078663fde3dc9fd92355e784')
+    id_mulsig_left = Id('e34d37fdeb88addac291ae0fa084f33490d756d8298e7219b0d4f073616dd251')
+    id_mulsig_right = Id('4d87652d513e0f7a5be51894b7fa862c8ca3ea8ef222f6b6ea7ed6a949f67672')
+    id_receiver = Id('e2bd3bf28c7e0994ef87a8d61b67f4f926ab2e315bc9f1e55da2394a594b4e66')
+
+    # relative lock: enable tx output can be spent only <rel_timelock> blocks after enable tx
+    tx_ep = signEnableTx(createEnableTx(chain.fund(id_ep_in.p2pkh, 1150), [id_ep_u1.public_key], rel_timelock, 1000), id_ep_in)
+    tx_ep_id = chain.broadcast(tx_ep)
+    chain.mine()
+
+    sequence = Sequence(TYPE_RELATIVE_TIMELOCK, rel_timelock).for_input_sequence()
+    tx = Transaction([TxInput(tx_ep_id, 0, sequence=sequence)], [TxOutput(1000 - fee, id_receiver.p2pkh)])
+    signature = id_ep_u1.private_key.sign_input(tx, 0, getEnableTxOutputLockScript(id_ep_u1.public_key, rel_timelock))
+    tx.inputs[0].script_sig = Script([signature, id_ep_u1.public_key.to_hex()])
+    chain.mine(rel_timelock - 2)
+    assertRejected(chain, tx, 'non-BIP68-final')
+
+    short_sequence = Sequence(TYPE_RELATIVE_TIMELOCK, rel_timelock - 1).for_input_sequence()
+    tx_short = Transaction([TxInput(tx_ep_id, 0, sequence=short_sequence)], [TxOutput(1000 - fee, id_receiver.p2pkh)])
+    signature = id_ep_u1.private_key.sign_input(tx_short, 0, getEnableTxOutputLockScript(id_ep_u1.public_key, rel_timelock))
+    tx_short.inputs[0].script_sig = Script([signature, id_ep_u1.public_key.to_hex()])
+    assertRejected(chain, tx_short, 'relative locktime requirement not satisfied')
+
+    chain.mine()
+    chain.broadcast(tx)
+
+    # absolute lock: tx_pay is valid once the tip is at height T (in block T + 1), and only with locktime T
+    state_lock_script = getTxStateLockScript(T, delta, id_pay_right.public_key, id_mulsig_left.public_key, id_mulsig_right.public_key,
+                                             id_mulsig_left.public_key, id_mulsig_right.public_key)
+    tx_state_lock_input = chain.fund(state_lock_script, 500)
+    tx_state_lock_input.sequence = Sequence(TYPE_RELATIVE_TIMELOCK, delta).for_input_sequence()
+
+    chain.mine_until(T - 1)
+    tx_pay = createTxPayAndSign(tx_state_lock_input, id_pay_right, state_lock_script, id_receiver, 500, fee, T)
+    assertRejected(chain, tx_pay, 'non-final')
+    chain.mine()
+    assertRejected(chain, createTxPayAndSign(tx_state_lock_input, id_pay_right, state_lock_script, id_receiver, 500, fee, T - 1),
+                   'locktime requirement not satisfied')
+    chain.broadcast(tx_pay)
+
+
 if __name__ == '__main__':
     # print(wif_to_private_key('cVBTEB2s94WftLPmCvH7iJoEcCZBEZthNnADJGUwQtGfMNGBEAyC'))
     main()
     # split_funds()
+    # simulate_load()
 
 
 
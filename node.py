@@ -0,0 +1,657 @@
+import hashlib
+import hmac
+import itertools
+import os
+import queue
+import threading
+import time
+import zlib
+from collections import deque
+from multiprocessing import AuthenticationError, Pipe, Process
+from multiprocessing.connection import Client, Connection, Listener, wait
+from typing import Dict, List, Optional, Tuple
+
+from ecdsa import SECP256k1, VerifyingKey
+
+from bitcoinutils import setup
+from bitcoinutils.keys import PrivateKey, PublicKey
+from bitcoinutils.transactions import Transaction, TxInput
+
+import blitz_transactions
+import rapid_transactions
+from channel import getChannelLockScript, signChannelStateTx
+from helper import Id, RawScript, verify_input_signature
+
+RAPID_KEYS = ['pubkey_left', 'pubkey_right', 'pubkey_pay_right', 'pubkey_refund_mulsig_left', 'pubkey_refund_mulsig_right',
+              'pubkey_pay_mulsig_left', 'pubkey_pay_mulsig_right']
+BLITZ_KEYS = ['pubkey_left', 'pubkey_right', 'pubkey_pay_right', 'pubkey_mulsig_left', 'pubkey_mulsig_right']
+# keys of tx_state owned by the node, by (protocol, side of the node)
+OWN_KEYS = {
+    ('rapid', 'left'): ['pubkey_left', 'pubkey_refund_mulsig_left', 'pubkey_pay_mulsig_left'],
+    ('rapid', 'right'): ['pubkey_right', 'pubkey_pay_right', 'pubkey_refund_mulsig_right', 'pubkey_pay_mulsig_right'],
+    ('blitz', 'left'): ['pubkey_left', 'pubkey_mulsig_left'],
+    ('blitz', 'right'): ['pubkey_right', 'pubkey_pay_right', 'pubkey_mulsig_right'],
+}
+DEFAULT_ADDRESS = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or os.path.expanduser('~'), 'rapid-node.sock')
+MIN_AUTHKEY_SIZE = 16
+SIGNER_CACHE_SIZE = 4096
+MAX_SIGNER_JOBS = 64  # unanswered jobs of a shard per signer, keeps both directions of a pipe below its buffer size
+MAX_CLIENT_BACKLOG = 1024  # unanswered requests of a client, client is not read while its backlog is full
+WORKERS_CHECK_INTERVAL = 1  # seconds between checks that all worker processes are alive
+SIDES = ('left', 'right')
+
+_CLOSE = object()
+
+
+def _deriveSecret(seed: bytes, data: bytes) -> str:
+    digest = hmac.new(seed, data, hashlib.sha256).digest()
+    return '%064x' % (int.from_bytes(digest, 'big') % (SECP256k1.order - 1) + 1)
+
+
+def getChannelSecret(seed: bytes, channel_id: str) -> str:
+    """
+    :param seed: secret seed of the node
+    :param channel_id: channel id
+    :return: secret of node key in channel 2/2 multisig. Derived inside worker processes, so keys never travel over IPC
+    """
+
+    return _deriveSecret(seed, b'channel:' + channel_id.encode())
+
+
+def getStateSecret(seed: bytes, channel_id: str, sequence: int, name: str) -> str:
+    """
+    :param seed: secret seed of the node
+    :param channel_id: channel id
+    :param sequence: channel state the payment is built from
+    :param name: key of tx_state owned by the node, see OWN_KEYS
+    :return: secret of node key in tx_state of the payment, a new one for every channel state
+    """
+
+    return _deriveSecret(seed, b'state:%s:%d:%s' % (channel_id.encode(), sequence, name.encode()))
+
+
+def parsePublicKey(hex_key: str) -> PublicKey:
+    """
+    :param hex_key: compressed or uncompressed public key in hex
+    :return: public key. Raises ValueError if it is not a point of secp256k1
+    """
+
+    try:
+        VerifyingKey.from_string(bytes.fromhex(hex_key), curve=SECP256k1)
+        return PublicKey(hex_key)
+    except Exception:
+        raise ValueError(f'invalid public key {hex_key!r}') from None
+
+
+def getShard(channel_id: str, shards: int) -> int:
+    return zlib.crc32(channel_id.encode()) % shards
+
+
+class Channel:
+    """
+    Channel owned by a single shard process, the node is one of its sides. Requests for a channel are handled
+    one by one in arrival order: while tx_state of a payment is being signed, later requests of the channel wait
+    """
+
+    def __init__(self, channel_id: str, id_node: Id, side: str, pubkey_counterparty: PublicKey, txid: str, index: int,
+                 balance_left: int, balance_right: int):
+        """
+        :param id_node: node key in channel 2/2 multisig
+        :param side: side of the node in channel, 'left' or 'right'
+        :param pubkey_counterparty: key of the other side in channel 2/2 multisig
+        :param txid: channel open transaction
+        :param index: index of channel output in channel open transaction
+        """
+
+        if side not in SIDES:
+            raise ValueError(f'side should be one of {SIDES}')
+        if balance_left < 0 or balance_right < 0:
+            raise ValueError('negative balance')
+        self.channel_id = channel_id
+        self.side = side
+        self.pubkey = id_node.public_key
+        self.pubkey_counterparty = pubkey_counterparty
+        if side == 'left':
+            self.lock_script_hex = getChannelLockScript(self.pubkey, pubkey_counterparty).to_hex()
+        else:
+            self.lock_script_hex = getChannelLockScript(pubkey_counterparty, self.pubkey).to_hex()
+        self.tx_in = TxInput(txid, index)
+        self.balance_left = balance_left
+        self.balance_right = balance_right
+        self.locked = 0
+        self.sequence = 0
+        self.pending: Optional[tuple] = None  # (token, tx_state, lock amount, counterparty signature) while signing
+        self.waiting = deque()  # (token, request) received while a payment is pending
+        self.own_keys_cache: Optional[tuple] = None  # (sequence, protocol, keys)
+
+    def own_keys(self, seed: bytes, protocol: str) -> Dict[str, str]:
+        """
+        :param seed: secret seed of the node
+        :param protocol: 'rapid' or 'blitz'
+        :return: hex public keys of the node in tx_state of the next payment, see OWN_KEYS
+        """
+
+        if (protocol, self.side) not in OWN_KEYS:
+            raise ValueError(f'unknown protocol {protocol}')
+        if self.own_keys_cache is None or self.own_keys_cache[:2] != (self.sequence, protocol):
+            keys = {}
+            for name in OWN_KEYS[(protocol, self.side)]:
+                secret = getStateSecret(seed, self.channel_id, self.sequence, name)
+                keys[name] = PrivateKey(secret_exponent=int(secret, 16)).get_public_key().to_hex()
+            self.own_keys_cache = (self.sequence, protocol, keys)
+        return self.own_keys_cache[2]
+
+    def create_state(self, request: dict, seed: bytes) -> Tuple[Transaction, int]:
+        """
+        Lock coins of left user for a payment to right: 'a' coins to L, 'b' coins to R -> 'a - c' to L, 'b' to R, 'c' locked.
+        Channel is not changed until tx_state is signed, see lock()
+
+        :param request: lock_amount, T, delta, protocol ('rapid' or 'blitz') and hex public keys of counterparty
+        for tx_state. Keys of the node may be omitted, if given they must be the ones from own_keys()
+        :param seed: secret seed of the node
+        :return: unsigned tx_state and lock amount
+        """
+
+        if self.locked:
+            raise ValueError('previous payment is not settled')
+        lock_amount = request['lock_amount']
+        if not isinstance(lock_amount, int) or lock_amount <= 0 or lock_amount > self.balance_left:
+            raise ValueError('invalid lock amount')
+
+        protocol = request.get('protocol', 'rapid')
+        own_keys = self.own_keys(seed, protocol)
+        keys = []
+        for name in (RAPID_KEYS if protocol == 'rapid' else BLITZ_KEYS):
+            if name not in own_keys:
+                keys.append(parsePublicKey(request[name]))
+            elif name in request and parsePublicKey(request[name]).to_hex() != own_keys[name]:
+                raise ValueError(f'{name} is not a key of the node')
+            else:
+                keys.append(PublicKey(own_keys[name]))
+
+        create = rapid_transactions.createTxState if protocol == 'rapid' else blitz_transactions.createTxState
+        tx_state = create(self.tx_in, *keys, lock_amount, self.balance_left - lock_amount, self.balance_right,
+                          request['T'], request['delta'])
+        return tx_state, lock_amount
+
+    def lock(self, lock_amount: int) -> None:
+        self.balance_left -= lock_amount
+        self.locked = lock_amount
+        self.sequence += 1
+
+    def settle(self, paid: bool) -> None:
+        """
+        :param paid: locked coins went to right user, otherwise they are refunded to left
+        """
+
+        if not self.locked:
+            raise ValueError('no payment to settle')
+        if paid:
+            self.balance_right += self.locked
+        else:
+            self.balance_left += self.locked
+        self.locked = 0
+        self.sequence += 1
+
+    def balances(self) -> dict:
+        return {'balance_left': self.balance_left, 'balance_right': self.balance_right,
+                'locked': self.locked, 'sequence': self.sequence}
+
+
+def _runSigner(conns: List[Connection], network: str, seed: bytes) -> None:
+    """
+    Signing pool worker. Every shard has its own pipe to every signer, so no queue is shared between processes
+
+    Job: (token, channel id, tx hex, channel lock script hex, counterparty pubkey hex, counterparty signature),
+    reply: (token, node signature or None, error or None)
+    """
+
+    setup.setup(network)
+    ids: Dict[str, Id] = {}
+    conns = list(conns)
+    while conns:
+        for conn in wait(conns):
+            try:
+                job = conn.recv()
+            except EOFError:
+                job = None
+            if job is None:
+                conns.remove(conn)
+                continue
+
+            token, channel_id, tx_hex, script_hex, pubkey_hex, signature_counterparty = job
+            try:
+                tx = Transaction.from_raw(tx_hex)
+                script = RawScript(bytes.fromhex(script_hex))
+                if not verify_input_signature(tx, 0, script, PublicKey(pubkey_hex), signature_counterparty):
+                    raise ValueError('invalid counterparty signature of tx_state')
+                signer = ids.get(channel_id)
+                if signer is None:
+                    if len(ids) >= SIGNER_CACHE_SIZE:
+                        ids.clear()
+                    signer = ids[channel_id] = Id(getChannelSecret(seed, channel_id))
+                reply = (token, signer.private_key.sign_input(tx, 0, script), None)
+            except Exception as e:
+                reply = (token, None, str(e) or type(e).__name__)
+            conn.send(reply)
+
+
+class _Shard:
+    def __init__(self, requests: Connection, signers: List[Connection], seed: bytes):
+        self.requests = requests
+        self.signers = signers
+        self.seed = seed
+        self.jobs = {signer: 0 for signer in signers}  # unanswered jobs of each signer
+        self.queued = deque()  # jobs waiting for a signer below MAX_SIGNER_JOBS
+        self.channels: Dict[str, Channel] = {}
+        self.pending: Dict[int, Channel] = {}  # token -> channel of payment being signed
+
+    def submit(self, job: tuple) -> None:
+        signer = min(self.signers, key=self.jobs.__getitem__)
+        if self.jobs[signer] >= MAX_SIGNER_JOBS:
+            self.queued.append(job)
+            return
+        self.jobs[signer] += 1
+        signer.send(job)
+
+    def handle(self, token: int, request: dict) -> None:
+        """
+        Handle a request, any error is returned to the client as a response and never stops the shard
+        """
+
+        channel = self.channels.get(request.get('channel_id'))
+        if channel is not None and channel.pending is not None:
+            channel.waiting.append((token, request))
+            return
+
+        job = None
+        try:
+            op = request.get('op')
+            if op == 'key':
+                response = {'ok': True, 'pubkey': Id(getChannelSecret(self.seed, request['channel_id'])).public_key.to_hex()}
+            elif op == 'open':
+                if channel is not None:
+                    raise ValueError('channel already exists')
+                channel = Channel(request['channel_id'], Id(getChannelSecret(self.seed, request['channel_id'])), request['side'],
+                                  parsePublicKey(request['pubkey_counterparty']), request['txid'], request['index'],
+                                  request['balance_left'], request['balance_right'])
+                self.channels[channel.channel_id] = channel
+                response = {'ok': True, 'pubkey': channel.pubkey.to_hex(), **channel.balances()}
+            elif channel is None:
+                raise ValueError(f'unknown channel {request.get("channel_id")}')
+            elif op == 'payment_keys':
+                response = {'ok': True, 'sequence': channel.sequence, **channel.own_keys(self.seed, request.get('protocol', 'rapid'))}
+            elif op == 'pay':
+                tx_state, lock_amount = channel.create_state(request, self.seed)
+                signature = request['signature']
+                if not isinstance(signature, str):
+                    raise ValueError('signature should be a hex string')
+                job = (token, channel.channel_id, tx_state.serialize(), channel.lock_script_hex,
+                       channel.pubkey_counterparty.to_hex(), signature)
+                channel.pending = (token, tx_state, lock_amount, signature)
+                self.pending[token] = channel
+            elif op == 'settle':
+                channel.settle(request.get('paid', True))
+                response = {'ok': True, **channel.balances()}
+            elif op == 'balances':
+                response = {'ok': True, **channel.balances()}
+            else:
+                raise ValueError(f'unknown op {op}')
+        except KeyError as e:
+            response = {'ok': False, 'error': f'missing field {e.args[0]}'}
+        except Exception as e:
+            response = {'ok': False, 'error': str(e) or type(e).__name__}
+
+        if job is not None:
+            self.submit(job)
+        else:
+            self.requests.send((token, response))
+
+    def signed(self, token: int, signature: Optional[str], error: Optional[str]) -> None:
+        channel = self.pending.pop(token)
+        _, tx_state, lock_amount, signature_counterparty = channel.pending
+        channel.pending = None
+        if error is not None:
+            response = {'ok': False, 'error': error}
+        else:
+            if channel.side == 'left':
+                tx_state = signChannelStateTx(tx_state, signature, signature_counterparty)
+            else:
+                tx_state = signChannelStateTx(tx_state, signature_counterparty, signature)
+            channel.lock(lock_amount)
+            response = {'ok': True, 'tx_state': tx_state.serialize(), 'txid': tx_state.get_txid(),
+                        'signature': signature, **channel.balances()}
+        self.requests.send((token, response))
+
+        while channel.waiting and channel.pending is None:
+            self.handle(*channel.waiting.popleft())
+
+    def run(self) -> None:
+        while True:
+            for conn in wait([self.requests] + self.signers):
+                if conn is self.requests:
+                    message = conn.recv()
+                    if message is None:
+                        for signer in self.signers:
+                            signer.send(None)
+                        return
+                    self.handle(*message)
+                else:
+                    self.jobs[conn] -= 1
+                    self.signed(*conn.recv())
+                    if self.queued:
+                        self.submit(self.queued.popleft())
+
+
+def _runShard(requests: Connection, signers: List[Connection], network: str, seed: bytes) -> None:
+    setup.setup(network)
+    _Shard(requests, signers, seed).run()
+
+
+class _Writer:
+    """
+    Sends messages to a connection from its own thread, so a slow reader never blocks routing loop of the node
+    """
+
+    def __init__(self, conn: Connection):
+        self.conn = conn
+        self.queue = queue.SimpleQueue()
+        self.received = 0  # requests read from the connection, counted by routing loop
+        self.sent = 0  # messages sent to the connection, counted by writer thread
+        self.closed = False
+        threading.Thread(target=self._run, daemon=True).start()
+
+    @property
+    def backlog(self) -> int:
+        return self.received - self.sent
+
+    def send(self, message) -> None:
+        if not self.closed:
+            self.queue.put(message)
+
+    def close(self) -> None:
+        self.queue.put(_CLOSE)
+
+    def _run(self) -> None:
+        while True:
+            message = self.queue.get()
+            if message is _CLOSE:
+                break
+            try:
+                self.conn.send(message)
+            except OSError:
+                break
+            self.sent += 1
+        self.closed = True
+        self.conn.close()
+
+
+class PaymentNode:
+    """
+    Long-running payment node, one side of many channels. Channels are sharded by channel id over worker
+    processes, which build channel states in order and hand them to a pool of signing processes. Clients
+    talk to the node through multiprocessing.connection (see NodeClient).
+
+    The node holds only its own keys, derived from its seed: channel keys and its keys in tx_state of every
+    channel state (balance output and multisig keys, see OWN_KEYS), so a request can not make it co-sign
+    a tx_state that pays its side to somebody else's key. It co-signs tx_state with a signature of the
+    counterparty given in the request. Refund, pay and inst-pay transactions spend tx_state with per-payment
+    keys and do not change channel state, so the parties build them with rapid_transactions or
+    blitz_transactions (or take them from ladder.StateLadder)
+
+    Clients send pickled messages, so anybody who can connect and knows authkey can run code in the node.
+    The node listens on a unix socket readable only by its user by default, and the authkey has no default
+
+    Ops (every request has 'op' and 'channel_id'):
+    - key: node public key for the channel, to create channel open transaction
+    - open: side, pubkey_counterparty, txid, index, balance_left, balance_right
+    - payment_keys: protocol. Keys of the node for tx_state of the next payment
+    - pay: lock_amount, T, delta, protocol, public keys of counterparty for tx_state (RAPID_KEYS or BLITZ_KEYS
+      without OWN_KEYS) and signature: counterparty signature of tx_state. Response has signed tx_state and new balances
+    - settle: paid
+    - balances
+    - shutdown: stop the node
+    """
+
+    def __init__(self, seed: bytes, authkey: bytes, address=DEFAULT_ADDRESS, shards: Optional[int] = None,
+                 signers: Optional[int] = None, network: str = 'testnet'):
+        """
+        :param seed: secret seed of node keys
+        :param authkey: secret key for authentication of clients, at least MIN_AUTHKEY_SIZE bytes
+        :param address: address of local IPC listener: path of unix socket, created with mode 0600, or (host, port)
+        :param shards: number of shard processes, half of cpu count by default
+        :param signers: number of signing processes, half of cpu count by default
+        :param network: bitcoin network of keys and addresses
+        """
+
+        if len(authkey) < MIN_AUTHKEY_SIZE:
+            raise ValueError(f'authkey should have at least {MIN_AUTHKEY_SIZE} bytes')
+        cpus = os.cpu_count() or 2
+        self.seed = seed
+        self.address = address
+        self.authkey = authkey
+        self.shards_number = shards or max(1, cpus // 2)
+        self.signers_number = signers or max(1, cpus // 2)
+        self.network = network
+        self.processes: List[Process] = []
+        self.shards: List[Connection] = []
+        self.shard_writers: List[_Writer] = []
+        self.clients: Dict[Connection, _Writer] = {}
+        self.clients_lock = threading.Lock()
+        self.listener: Optional[Listener] = None
+        self.running = False
+
+    def start(self) -> None:
+        signer_conns = [[] for _ in range(self.signers_number)]
+        for _ in range(self.shards_number):
+            shard_ends = []
+            for conns in signer_conns:
+                shard_end, signer_end = Pipe()
+                shard_ends.append(shard_end)
+                conns.append(signer_end)
+            node_end, shard_end = Pipe()
+            self.shards.append(node_end)
+            self.shard_writers.append(_Writer(node_end))
+            self.processes.append(Process(target=_runShard, args=(shard_end, shard_ends, self.network, self.seed), daemon=True))
+        for conns in signer_conns:
+            self.processes.append(Process(target=_runSigner, args=(conns, self.network, self.seed), daemon=True))
+        for process in self.processes:
+            process.start()
+
+        if isinstance(self.address, str):
+            umask = os.umask(0o177)  # socket file is created by bind, so its mode is set by umask
+            try:
+                self.listener = Listener(self.address, 'AF_UNIX', authkey=self.authkey)
+            finally:
+                os.umask(umask)
+        else:
+            self.listener = Listener(self.address, authkey=self.authkey)
+        self.running = True
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self) -> None:
+        while self.running:
+            try:
+                conn = self.listener.accept()
+            except (AuthenticationError, EOFError):
+                continue
+            except OSError:
+                return
+            with self.clients_lock:
+                self.clients[conn] = _Writer(conn)
+
+    def _workers_alive(self) -> bool:
+        return all(process.is_alive() for process in self.processes)
+
+    def serve_forever(self) -> None:
+        """
+        Route client requests to shards and shard responses back to clients until stop() or 'shutdown' request.
+        Raises RuntimeError if a worker process dies, pending requests get an error response
+        """
+
+        tokens = itertools.count()
+        waiting: Dict[int, tuple] = {}  # token -> (client writer, request id)
+        checked = time.monotonic()
+        error = None
+        while self.running and error is None:
+            with self.clients_lock:
+                clients = [conn for conn, writer in self.clients.items() if writer.backlog < MAX_CLIENT_BACKLOG]
+            for conn in wait(self.shards + clients, timeout=0.1):
+                if conn in self.shards:
+                    try:
+                        token, response = conn.recv()
+                    except (EOFError, OSError):
+                        error = 'shard process died'
+                        break
+                    writer, request_id = waiting.pop(token)
+                    writer.send({'id': request_id, **response})
+                    continue
+
+                writer = self.clients[conn]
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    with self.clients_lock:
+                        del self.clients[conn]
+                    writer.close()
+                    continue
+                except Exception:
+                    request = None
+                writer.received += 1
+                if not isinstance(request, dict):
+                    writer.send({'id': None, 'ok': False, 'error': 'request should be a dict'})
+                    continue
+                if request.get('op') == 'shutdown':
+                    writer.send({'id': request.get('id'), 'ok': True})
+                    self.running = False
+                    break
+                channel_id = request.get('channel_id')
+                if not isinstance(channel_id, str):
+                    writer.send({'id': request.get('id'), 'ok': False, 'error': 'channel_id is required'})
+                    continue
+                token = next(tokens)
+                waiting[token] = (writer, request.get('id'))
+                self.shard_writers[getShard(channel_id, self.shards_number)].send((token, request))
+
+            if time.monotonic() - checked >= WORKERS_CHECK_INTERVAL:
+                checked = time.monotonic()
+                if not self._workers_alive():
+                    error = 'worker process died'
+
+        if error is not None:
+            for writer, request_id in waiting.values():
+                writer.send({'id': request_id, 'ok': False, 'error': error})
+        self.stop()
+        if error is not None:
+            raise RuntimeError(error)
+
+    def stop(self) -> None:
+        self.running = False
+        for writer in self.shard_writers:
+            writer.send(None)
+            writer.close()
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+        with self.clients_lock:
+            for writer in self.clients.values():
+                writer.close()
+            self.clients.clear()
+
+
+class NodeClient:
+    """
+    Client of local PaymentNode API. Requests can be pipelined: send() several of them, then recv() responses
+    """
+
+    def __init__(self, authkey: bytes, address=DEFAULT_ADDRESS):
+        self.conn = Client(address, authkey=authkey)
+        self.ids = itertools.count()
+
+    def send(self, op: str, **kwargs) -> int:
+        request_id = next(self.ids)
+        self.conn.send({'id': request_id, 'op': op, **kwargs})
+        return request_id
+
+    def recv(self) -> dict:
+        return self.conn.recv()
+
+    def call(self, op: str, **kwargs) -> dict:
+        self.send(op, **kwargs)
+        return self.recv()
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def test_payment_node():
+    from channel import getChannelStateScriptSigRight
+
+    setup.setup('testnet')
+    address = f'/tmp/rapid-node-{os.getpid()}.sock'
+    authkey = os.urandom(32)
+    node = PaymentNode(os.urandom(32), authkey, address, shards=2, signers=2)
+    node.start()
+    server = threading.Thread(target=node.serve_forever, daemon=True)
+    server.start()
+    assert os.stat(address).st_mode & 0o777 == 0o600
+    client = NodeClient(authkey, address)
+    other = NodeClient(authkey, address)
+    try:
+        NodeClient(b'rapid' * 4, address)
+    except AuthenticationError:
+        pass
+    else:
+        raise AssertionError('client with wrong authkey is accepted')
+
+    id_right = Id(os.urandom(32).hex())  # counterparty, node is left side
+    txid = os.urandom(32).hex()
+    pubkey_node = parsePublicKey(client.call('key', channel_id='c')['pubkey'])
+    response = client.call('open', channel_id='c', side='left', pubkey_counterparty=id_right.public_key.to_hex(),
+                           txid=txid, index=0, balance_left=1000, balance_right=500)
+    assert response['ok'] and response['pubkey'] == pubkey_node.to_hex()
+
+    # node gives its own keys of tx_state and rejects requests that replace them
+    response = client.call('payment_keys', channel_id='c')
+    keys = {name: response[name] if name in response else Id(os.urandom(32).hex()).public_key.to_hex() for name in RAPID_KEYS}
+    counterparty_keys = {name: key for name, key in keys.items() if name not in OWN_KEYS[('rapid', 'left')]}
+    payment = {'channel_id': 'c', 'lock_amount': 300, 'T': 2100200, 'delta': 10, **counterparty_keys}
+    assert client.call('pay', **payment, pubkey_left=keys['pubkey_right'], signature='00')['error'] == 'pubkey_left is not a key of the node'
+    tx_state = rapid_transactions.createTxState(TxInput(txid, 0), *[PublicKey(keys[name]) for name in RAPID_KEYS],
+                                                300, 700, 500, 2100200, 10)
+    signature = getChannelStateScriptSigRight(tx_state, id_right, pubkey_node)
+
+    assert client.call('pay', **{**payment, 'pubkey_pay_right': '02' + '00' * 32}, signature=signature)['error'].startswith('invalid public key')
+    assert client.call('pay', **payment, signature=signature[:-10] + '0' * 8 + signature[-2:])['error'] == 'invalid counterparty signature of tx_state'
+    assert client.call('balances', channel_id='c')['balance_left'] == 1000
+
+    response = client.call('pay', **payment, signature=signature)
+    assert response['ok'] and response['balance_left'] == 700 and response['locked'] == 300
+    tx_state = Transaction.from_raw(response['tx_state'])
+    lock_script = getChannelLockScript(pubkey_node, id_right.public_key)
+    assert verify_input_signature(tx_state, 0, lock_script, pubkey_node, response['signature'])
+
+    # client pipelines requests and does not read responses yet: node stops reading it and serves other clients
+    sender = threading.Thread(target=lambda: [client.send('balances', channel_id='c') for _ in range(20000)])
+    sender.start()
+    assert other.call('settle', channel_id='c', paid=True)['balance_right'] == 800
+    responses = [client.recv() for _ in range(20000)]
+    sender.join()
+    assert all(response['ok'] for response in responses)
+    assert other.call('payment_keys', channel_id='c')['pubkey_left'] != keys['pubkey_left']  # new keys for every state
+
+    assert other.call('shutdown')['ok']
+    server.join()
+    client.close()
+    other.close()
+
+
+if __name__ == '__main__':
+    node = PaymentNode(bytes.fromhex(os.environ['RAPID_NODE_SEED']), bytes.fromhex(os.environ['RAPID_NODE_AUTHKEY']),
+                       os.environ.get('RAPID_NODE_ADDRESS', DEFAULT_ADDRESS))
+    node.start()
+    node.serve_forever()
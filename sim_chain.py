@@ -0,0 +1,429 @@
+import hashlib
+import struct
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+
+from ecdsa import BadSignatureError, SECP256k1, VerifyingKey
+
+from bitcoinutils.script import Script
+from bitcoinutils.transactions import Transaction, TxInput
+
+from helper import LOCKTIME_THRESHOLD, RawScript, decode_der_signature, hash160
+
+SEQUENCE_FINAL = 0xffffffff
+SEQUENCE_LOCKTIME_DISABLE_FLAG = 1 << 31
+SEQUENCE_LOCKTIME_TYPE_FLAG = 1 << 22
+SEQUENCE_LOCKTIME_MASK = 0x0000ffff
+SEQUENCE_LOCKTIME_GRANULARITY = 9  # time based relative locks are counted in 512 seconds
+MEDIAN_TIME_SPAN = 11
+
+
+class TxRejected(Exception):
+    """Raised when a transaction is not accepted to the mempool of the simulated chain"""
+
+
+class Coin(NamedTuple):
+    amount: int
+    script_pubkey: bytes
+    height: int  # height of the block that created the coin, tip + 1 for unconfirmed coins
+
+
+def _decode_num(data: bytes, max_size: int = 4) -> int:
+    if len(data) > max_size:
+        raise TxRejected('script number overflow')
+    if not data:
+        return 0
+    result = int.from_bytes(data, 'little')
+    if data[-1] & 0x80:
+        return -(result & ~(0x80 << (8 * (len(data) - 1))))
+    return result
+
+
+def _encode_num(value: int) -> bytes:
+    if value == 0:
+        return b''
+    negative = value < 0
+    absolute = abs(value)
+    result = bytearray()
+    while absolute:
+        result.append(absolute & 0xff)
+        absolute >>= 8
+    if result[-1] & 0x80:
+        result.append(0x80 if negative else 0)
+    elif negative:
+        result[-1] |= 0x80
+    return bytes(result)
+
+
+def _is_true(data: bytes) -> bool:
+    for i, byte in enumerate(data):
+        if byte != 0:
+            return not (i == len(data) - 1 and byte == 0x80)
+    return False
+
+
+def _parse_script(raw: bytes) -> List[Tuple[int, Optional[bytes]]]:
+    ops = []
+    i = 0
+    while i < len(raw):
+        opcode = raw[i]
+        i += 1
+        if opcode <= 0x4e:
+            if opcode < 0x4c:
+                size = opcode
+            else:
+                width = {0x4c: 1, 0x4d: 2, 0x4e: 4}[opcode]
+                size = int.from_bytes(raw[i:i + width], 'little')
+                i += width
+            if i + size > len(raw):
+                raise TxRejected('truncated push in script')
+            ops.append((opcode, raw[i:i + size]))
+            i += size
+        else:
+            ops.append((opcode, None))
+    return ops
+
+
+def _sequence(tx_in: TxInput) -> int:
+    return int.from_bytes(tx_in.sequence, 'little')
+
+
+class _ScriptChecker:
+    """
+    Interpreter for the subset of legacy script used by channel, Rapid and Blitz transactions:
+    p2pkh, bare multisig, IF/ELSE branches, CHECKLOCKTIMEVERIFY and CHECKSEQUENCEVERIFY
+    """
+
+    def __init__(self, tx: Transaction, index: int, verify_signatures: bool):
+        self.tx = tx
+        self.index = index
+        self.verify_signatures = verify_signatures
+        self.digests = {}
+
+    def check_sig(self, sig: bytes, pubkey: bytes, script_code: bytes) -> bool:
+        if not sig:
+            return False
+        if not self.verify_signatures:
+            return True
+        hash_type = sig[-1]
+        if hash_type not in self.digests:
+            self.digests[hash_type] = self.tx.get_transaction_digest(self.index, RawScript(script_code), hash_type)
+        try:
+            key = VerifyingKey.from_string(pubkey, curve=SECP256k1)
+            return key.verify_digest(decode_der_signature(sig[:-1]), self.digests[hash_type], sigdecode=lambda rs, order: rs)
+        except (BadSignatureError, ValueError, IndexError, AssertionError):
+            return False
+
+    def check_locktime(self, locktime: int) -> None:
+        if locktime < 0:
+            raise TxRejected('negative locktime')
+        tx_locktime = struct.unpack('<I', self.tx.locktime)[0]
+        if (locktime < LOCKTIME_THRESHOLD) != (tx_locktime < LOCKTIME_THRESHOLD):
+            raise TxRejected('locktime type mismatch')
+        if locktime > tx_locktime:
+            raise TxRejected('locktime requirement not satisfied')
+        if _sequence(self.tx.inputs[self.index]) == SEQUENCE_FINAL:
+            raise TxRejected('locktime requirement not satisfied: input is final')
+
+    def check_sequence(self, sequence: int) -> None:
+        if sequence < 0:
+            raise TxRejected('negative sequence')
+        if sequence & SEQUENCE_LOCKTIME_DISABLE_FLAG:
+            return
+        if struct.unpack('<I', self.tx.version)[0] < 2:
+            raise TxRejected('relative locktime requires tx version 2')
+        tx_sequence = _sequence(self.tx.inputs[self.index])
+        if tx_sequence & SEQUENCE_LOCKTIME_DISABLE_FLAG:
+            raise TxRejected('relative locktime disabled on input')
+        mask = SEQUENCE_LOCKTIME_TYPE_FLAG | SEQUENCE_LOCKTIME_MASK
+        if (sequence & SEQUENCE_LOCKTIME_TYPE_FLAG) != (tx_sequence & SEQUENCE_LOCKTIME_TYPE_FLAG):
+            raise TxRejected('relative locktime type mismatch')
+        if sequence & mask > tx_sequence & mask:
+            raise TxRejected('relative locktime requirement not satisfied')
+
+    def run(self, script: bytes, stack: List[bytes]) -> None:
+        exec_stack = []
+        for opcode, data in _parse_script(script):
+            executing = all(exec_stack)
+            if data is not None:
+                if executing:
+                    stack.append(data)
+                continue
+            if 0x63 <= opcode <= 0x68:
+                if opcode in (0x63, 0x64):  # OP_IF, OP_NOTIF
+                    value = False
+                    if executing:
+                        value = _is_true(self.pop(stack))
+                        if opcode == 0x64:
+                            value = not value
+                    exec_stack.append(value)
+                elif opcode == 0x67:  # OP_ELSE
+                    if not exec_stack:
+                        raise TxRejected('unbalanced conditional')
+                    exec_stack[-1] = not exec_stack[-1]
+                elif opcode == 0x68:  # OP_ENDIF
+                    if not exec_stack:
+                        raise TxRejected('unbalanced conditional')
+                    exec_stack.pop()
+                else:
+                    raise TxRejected(f'unsupported opcode {opcode:#x}')
+                continue
+            if not executing:
+                continue
+            self.step(opcode, stack, script)
+        if exec_stack:
+            raise TxRejected('unbalanced conditional')
+
+    @staticmethod
+    def pop(stack: List[bytes]) -> bytes:
+        if not stack:
+            raise TxRejected('stack underflow')
+        return stack.pop()
+
+    def step(self, opcode: int, stack: List[bytes], script: bytes) -> None:
+        if opcode == 0x4f or 0x51 <= opcode <= 0x60:  # OP_1NEGATE, OP_1 ... OP_16
+            stack.append(_encode_num(opcode - 0x50))
+        elif opcode == 0x69:  # OP_VERIFY
+            if not _is_true(self.pop(stack)):
+                raise TxRejected('OP_VERIFY failed')
+        elif opcode == 0x75:  # OP_DROP
+            self.pop(stack)
+        elif opcode == 0x76:  # OP_DUP
+            stack.append(self.pop(stack))
+            stack.append(stack[-1])
+        elif opcode in (0x87, 0x88):  # OP_EQUAL, OP_EQUALVERIFY
+            equal = self.pop(stack) == self.pop(stack)
+            if opcode == 0x88 and not equal:
+                raise TxRejected('OP_EQUALVERIFY failed')
+            if opcode == 0x87:
+                stack.append(b'\x01' if equal else b'')
+        elif opcode == 0xa9:  # OP_HASH160
+            stack.append(hash160(self.pop(stack)))
+        elif opcode in (0xac, 0xad):  # OP_CHECKSIG, OP_CHECKSIGVERIFY
+            pubkey = self.pop(stack)
+            valid = self.check_sig(self.pop(stack), pubkey, script)
+            if opcode == 0xad and not valid:
+                raise TxRejected('OP_CHECKSIGVERIFY failed')
+            if opcode == 0xac:
+                stack.append(b'\x01' if valid else b'')
+        elif opcode == 0xae:  # OP_CHECKMULTISIG
+            pubkeys = [self.pop(stack) for _ in range(_decode_num(self.pop(stack)))][::-1]
+            sigs = [self.pop(stack) for _ in range(_decode_num(self.pop(stack)))][::-1]
+            self.pop(stack)  # extra value consumed by CHECKMULTISIG
+            valid = True
+            for sig in sigs:
+                while pubkeys and not self.check_sig(sig, pubkeys[0], script):
+                    pubkeys.pop(0)
+                if not pubkeys:
+                    valid = False
+                    break
+                pubkeys.pop(0)
+            stack.append(b'\x01' if valid else b'')
+        elif opcode == 0xb1:  # OP_CHECKLOCKTIMEVERIFY
+            if not stack:
+                raise TxRejected('stack underflow')
+            self.check_locktime(_decode_num(stack[-1], 5))
+        elif opcode == 0xb2:  # OP_CHECKSEQUENCEVERIFY
+            if not stack:
+                raise TxRejected('stack underflow')
+            self.check_sequence(_decode_num(stack[-1], 5))
+        else:
+            raise TxRejected(f'unsupported opcode {opcode:#x}')
+
+
+class SimChain:
+    """
+    In-process stand-in for the Bitcoin network: mempool, UTXO set and blocks mined on demand.
+    Absolute (nLockTime, CHECKLOCKTIMEVERIFY) and relative (BIP68 sequence, CHECKSEQUENCEVERIFY)
+    timelocks are enforced against block heights and median time past of a controllable clock.
+    """
+
+    def __init__(self, height: int = 0, time: int = 1600000000, block_interval: int = 600,
+                 verify_signatures: bool = True):
+        """
+        :param height: height of the initial block
+        :param time: timestamp of the initial block
+        :param block_interval: seconds between mined blocks, unless the clock is moved by hand
+        :param verify_signatures: check ECDSA signatures. Disable for load testing, when only
+        scripts structure and timelocks matter
+        """
+
+        self.block_interval = block_interval
+        self.verify_signatures = verify_signatures
+        self.height = height
+        self.block_times = [time]
+        self.clock = time + block_interval
+        self.utxos: Dict[Tuple[str, int], Coin] = {}
+        self.tx_heights: Dict[str, int] = {}
+        self.mempool: Dict[str, Transaction] = OrderedDict()
+        self.mempool_spent: Dict[Tuple[str, int], str] = {}
+        self._fund_counter = 0
+
+    def median_time_past(self, height: Optional[int] = None) -> int:
+        """
+        :param height: block height, tip by default
+        :return: median timestamp of the last 11 blocks up to the given height
+        """
+
+        end = len(self.block_times) if height is None else max(1, height - self.height + len(self.block_times))
+        times = sorted(self.block_times[max(0, end - MEDIAN_TIME_SPAN):end])
+        return times[len(times) // 2]
+
+    def advance_time(self, seconds: int) -> None:
+        """
+        Move the clock forward: timestamp of the next mined block
+
+        :param seconds: seconds to add to the clock
+        """
+
+        self.clock += seconds
+
+    def fund(self, script_pubkey: Script, amount: int) -> TxInput:
+        """
+        Create a confirmed coin out of thin air, the way a faucet would
+
+        :param script_pubkey: lock script of the coin, for example Id.p2pkh
+        :param amount: value of the coin in satoshis
+        :return: reference to the new coin
+        """
+
+        self._fund_counter += 1
+        txid = hashlib.sha256(b'sim_chain fund %d' % self._fund_counter).digest()[::-1].hex()
+        self.utxos[(txid, 0)] = Coin(amount, script_pubkey.to_bytes(), self.height)
+        self.tx_heights[txid] = self.height
+        return TxInput(txid, 0)
+
+    def get_coin(self, txid: str, index: int) -> Optional[Coin]:
+        """
+        :return: unspent output, confirmed or from mempool, None if it does not exist or is spent
+        """
+
+        outpoint = (txid, index)
+        if outpoint in self.mempool_spent:
+            return None
+        if outpoint in self.utxos:
+            return self.utxos[outpoint]
+        tx = self.mempool.get(txid)
+        if tx is not None and index < len(tx.outputs):
+            out = tx.outputs[index]
+            return Coin(out.amount, out.script_pubkey.to_bytes(), self.height + 1)
+        return None
+
+    def confirmations(self, txid: str) -> int:
+        """
+        :return: number of confirmations of transaction, 0 if it is in mempool or unknown
+        """
+
+        if txid not in self.tx_heights:
+            return 0
+        return self.height - self.tx_heights[txid] + 1
+
+    def broadcast(self, tx: Union[Transaction, str]) -> str:
+        """
+        Validate transaction against the next block and add it to the mempool
+
+        :param tx: transaction object or its serialization
+        :return: txid
+        """
+
+        if isinstance(tx, str):
+            tx = Transaction.from_raw(tx)
+        txid = tx.get_txid()
+        if txid in self.mempool or txid in self.tx_heights:
+            raise TxRejected('transaction already known')
+
+        self.check_tx(tx)
+
+        self.mempool[txid] = tx
+        for tx_in in tx.inputs:
+            self.mempool_spent[(tx_in.txid, tx_in.txout_index)] = txid
+        return txid
+
+    def check_tx(self, tx: Transaction) -> None:
+        """
+        Check that transaction can be included in the next block, raises TxRejected otherwise
+
+        :param tx: transaction to check
+        """
+
+        if not tx.inputs or not tx.outputs:
+            raise TxRejected('transaction has no inputs or outputs')
+        outpoints = [(tx_in.txid, tx_in.txout_index) for tx_in in tx.inputs]
+        if len(set(outpoints)) != len(outpoints):
+            raise TxRejected('duplicate inputs')
+
+        coins = []
+        for txid, index in outpoints:
+            coin = self.get_coin(txid, index)
+            if coin is None:
+                raise TxRejected(f'missing or spent input {txid}:{index}')
+            coins.append(coin)
+
+        if any(out.amount < 0 for out in tx.outputs):
+            raise TxRejected('negative output value')
+        if sum(out.amount for out in tx.outputs) > sum(coin.amount for coin in coins):
+            raise TxRejected('outputs exceed inputs')
+
+        next_height = self.height + 1
+        mtp = self.median_time_past()
+
+        locktime = struct.unpack('<I', tx.locktime)[0]
+        if locktime != 0 and any(_sequence(tx_in) != SEQUENCE_FINAL for tx_in in tx.inputs):
+            if locktime >= (next_height if locktime < LOCKTIME_THRESHOLD else mtp):
+                raise TxRejected('non-final transaction')
+
+        if struct.unpack('<I', tx.version)[0] >= 2:
+            for tx_in, coin in zip(tx.inputs, coins):
+                sequence = _sequence(tx_in)
+                if sequence & SEQUENCE_LOCKTIME_DISABLE_FLAG:
+                    continue
+                value = sequence & SEQUENCE_LOCKTIME_MASK
+                if sequence & SEQUENCE_LOCKTIME_TYPE_FLAG:
+                    coin_time = self.median_time_past(coin.height - 1) if coin.height <= self.height else mtp
+                    if mtp < coin_time + (value << SEQUENCE_LOCKTIME_GRANULARITY):
+                        raise TxRejected('non-BIP68-final transaction')
+                elif next_height < coin.height + value:
+                    raise TxRejected('non-BIP68-final transaction')
+
+        for index, coin in enumerate(coins):
+            checker = _ScriptChecker(tx, index, self.verify_signatures)
+            stack = []
+            checker.run(tx.inputs[index].script_sig.to_bytes(), stack)
+            checker.run(coin.script_pubkey, stack)
+            if not stack or not _is_true(stack[-1]):
+                raise TxRejected(f'script evaluated to false for input {index}')
+
+    def mine(self, blocks: int = 1) -> List[str]:
+        """
+        Mine blocks. The first one includes the whole mempool, the rest are empty
+
+        :param blocks: number of blocks to mine
+        :return: txids included in the first block
+        """
+
+        included = list(self.mempool)
+        for _ in range(blocks):
+            self.height += 1
+            self.block_times.append(max(self.clock, self.median_time_past() + 1))
+            self.clock = self.block_times[-1] + self.block_interval
+
+            for txid, tx in self.mempool.items():
+                for tx_in in tx.inputs:
+                    del self.utxos[(tx_in.txid, tx_in.txout_index)]
+                for index, out in enumerate(tx.outputs):
+                    self.utxos[(txid, index)] = Coin(out.amount, out.script_pubkey.to_bytes(), self.height)
+                self.tx_heights[txid] = self.height
+            self.mempool.clear()
+            self.mempool_spent.clear()
+
+        return included
+
+    def mine_until(self, height: int) -> None:
+        """
+        Mine blocks until the tip reaches given height
+
+        :param height: target height
+        """
+
+        if height > self.height:
+            self.mine(height - self.height)